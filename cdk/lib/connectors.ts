@@ -24,6 +24,26 @@ export class ConnectorsStack extends cdk.Stack {
       enforceSSL: true,
       versioned: false,
       removalPolicy: cdk.RemovalPolicy.RETAIN,
+      lifecycleRules: [
+        {
+          // Listing batch files are only read by the execution that wrote them
+          prefix: 'batches/',
+          expiration: cdk.Duration.days(7),
+        },
+        {
+          // PDFs are staged there while their hash is computed, then moved
+          prefix: 'pdfs/eco/staging/',
+          expiration: cdk.Duration.days(1),
+        },
+        {
+          // Manifests of listings whose processing failed are never committed
+          prefix: 'manifests/eco/pending/',
+          expiration: cdk.Duration.days(7),
+        },
+        {
+          abortIncompleteMultipartUploadAfter: cdk.Duration.days(1),
+        },
+      ],
     })
 
 
@@ -32,10 +52,16 @@ export class ConnectorsStack extends cdk.Stack {
       compatibleRuntimes: [LAMBDA_PYTHON_RUNTIME],
     });
 
+    // The handlers import the shared `common` package, so the whole connectors
+    // tree is shipped and handlers are addressed by their path inside it.
+    const connectorsCode = lambda.Code.fromAsset(path.join(__dirname, '../../connectors'), {
+      exclude: ['lambda_layers', 'bruno', 'inies', 'tests', 'benchmarks', '*.egg-info', '**/__pycache__', '.DS_Store'],
+    });
+
     const getAllEpdInfosLambda = new lambda.Function(this, 'GetAllEpdInfosEcoPlatformLambda', {
       runtime: LAMBDA_PYTHON_RUNTIME,
-      handler: 'get_all_epd_infos.lambda_handler',
-      code: lambda.Code.fromAsset(path.join(__dirname, '../../connectors/ecoplatform/lambda')),
+      handler: 'ecoplatform/lambda/get_all_epd_infos.lambda_handler',
+      code: connectorsCode,
       timeout: cdk.Duration.minutes(5),
       layers: [requestsLayer],
       environment: {
@@ -45,9 +71,36 @@ export class ConnectorsStack extends cdk.Stack {
 
     const getEpdDataLambda = new lambda.Function(this, 'GetEpdDataEcoPlatformLambda', {
       runtime: LAMBDA_PYTHON_RUNTIME,
-      handler: 'get_epd_data.lambda_handler',
-      code: lambda.Code.fromAsset(path.join(__dirname, '../../connectors/ecoplatform/lambda')),
+      handler: 'ecoplatform/lambda/get_epd_data.lambda_handler',
+      code: connectorsCode,
       timeout: cdk.Duration.minutes(15),
+      // Up to EPD_FETCH_CONCURRENCY bodies are decoded or compressed at once,
+      // and Lambda CPU grows with memory.
+      memorySize: 1024,
+      layers: [requestsLayer],
+      environment: {
+        "BUCKET_NAME": bucket.bucketName
+      }
+    });
+
+    const getEpdPdfsLambda = new lambda.Function(this, 'GetEpdPdfsEcoPlatformLambda', {
+      runtime: LAMBDA_PYTHON_RUNTIME,
+      handler: 'ecoplatform/lambda/get_epd_pdfs.lambda_handler',
+      code: connectorsCode,
+      timeout: cdk.Duration.minutes(15),
+      // Each of the PDF_FETCH_CONCURRENCY threads holds one 5 MiB part at most.
+      memorySize: 512,
+      layers: [requestsLayer],
+      environment: {
+        "BUCKET_NAME": bucket.bucketName
+      }
+    });
+
+    const commitListingManifestLambda = new lambda.Function(this, 'CommitListingManifestEcoPlatformLambda', {
+      runtime: LAMBDA_PYTHON_RUNTIME,
+      handler: 'ecoplatform/lambda/commit_listing_manifest.lambda_handler',
+      code: connectorsCode,
+      timeout: cdk.Duration.minutes(1),
       layers: [requestsLayer],
       environment: {
         "BUCKET_NAME": bucket.bucketName
@@ -61,6 +114,7 @@ export class ConnectorsStack extends cdk.Stack {
         's3:GetObject',
         's3:PutObject',
         's3:DeleteObject',
+        's3:AbortMultipartUpload',
       ],
       resources: [
         `arn:aws:s3:::${bucket.bucketName}`,
@@ -78,6 +132,9 @@ export class ConnectorsStack extends cdk.Stack {
     getAllEpdInfosLambda.addToRolePolicy(secretsManagerPolicy);
     getEpdDataLambda.addToRolePolicy(s3Policy);
     getEpdDataLambda.addToRolePolicy(secretsManagerPolicy);
+    getEpdPdfsLambda.addToRolePolicy(s3Policy);
+    getEpdPdfsLambda.addToRolePolicy(secretsManagerPolicy);
+    commitListingManifestLambda.addToRolePolicy(s3Policy);
 
     // Step Function Tasks
     const getAllEpdInfosTask = new tasks.LambdaInvoke(this, 'Get All EPD Infos', {
@@ -99,15 +156,75 @@ export class ConnectorsStack extends cdk.Stack {
       outputPath: '$.Payload',
     });
 
-    batchProcessingTask.itemProcessor(processBatchTask);
+    // A worker running out of time returns a continuation with the records it
+    // has not started, and is invoked again on it with its counts carried over.
+    const continueBatchChoice = new sfn.Choice(this, 'Continue Batch?')
+      .when(sfn.Condition.and(
+        sfn.Condition.isPresent('$.continuation'),
+        sfn.Condition.isNotNull('$.continuation'),
+      ), processBatchTask)
+      .otherwise(new sfn.Succeed(this, 'Batch Processed'));
+
+    batchProcessingTask.itemProcessor(processBatchTask.next(continueBatchChoice));
+
+    // Map State downloading the EPD PDFs of the same batches
+    const pdfProcessingTask = new sfn.Map(this, 'Process PDFs', {
+      itemsPath: '$.inputBatchesS3Keys',
+      maxConcurrency: 5,
+      resultPath: '$.output.pdfResults',
+      outputPath: '$.output',
+    });
+
+    const processPdfsTask = new tasks.LambdaInvoke(this, 'Get EPD PDFs', {
+      lambdaFunction: getEpdPdfsLambda,
+      outputPath: '$.Payload',
+    });
+
+    const continuePdfsChoice = new sfn.Choice(this, 'Continue PDFs?')
+      .when(sfn.Condition.and(
+        sfn.Condition.isPresent('$.continuation'),
+        sfn.Condition.isNotNull('$.continuation'),
+      ), processPdfsTask)
+      .otherwise(new sfn.Succeed(this, 'PDFs Processed'));
+
+    pdfProcessingTask.itemProcessor(processPdfsTask.next(continuePdfsChoice));
+
+    // The listing output is kept for the manifest commit that follows
+    const processingTask = new sfn.Parallel(this, 'Process Batches And PDFs', {
+      resultPath: '$.processingResults',
+    })
+      .branch(batchProcessingTask)
+      .branch(pdfProcessingTask);
+
+    // The listing manifest only becomes current once every batch succeeded,
+    // so that a failed run is listed again by the next one
+    const commitListingManifestTask = new tasks.LambdaInvoke(this, 'Commit Listing Manifest', {
+      lambdaFunction: commitListingManifestLambda,
+      payload: sfn.TaskInput.fromObject({
+        pendingManifestS3Key: sfn.JsonPath.stringAt('$.pendingManifestS3Key'),
+      }),
+      resultPath: sfn.JsonPath.DISCARD,
+    });
+    processingTask.next(commitListingManifestTask);
+
+
+    // An interrupted listing checkpoints its cursor and asks to be resumed
+    const waitBeforeResumingListing = new sfn.Wait(this, 'Wait Before Resuming Listing', {
+      time: sfn.WaitTime.duration(cdk.Duration.seconds(30)),
+    });
+    waitBeforeResumingListing.next(getAllEpdInfosTask);
 
+    const resumeListingChoice = new sfn.Choice(this, 'Resume Listing?')
+      .when(sfn.Condition.booleanEquals('$.resumeListing', true), waitBeforeResumingListing)
+      .otherwise(processingTask);
 
     // Step Function definition
-    const definition = getAllEpdInfosTask.next(batchProcessingTask);
+    const definition = getAllEpdInfosTask.next(resumeListingChoice);
 
     const stateMachine = new sfn.StateMachine(this, 'ExtractEpdRawDataEcoPlatformSfn', {
       definitionBody: sfn.DefinitionBody.fromChainable(definition),
-      timeout: cdk.Duration.minutes(60),
+      // Slow upstream days take more worker iterations rather than failing.
+      timeout: cdk.Duration.hours(6),
     });
   }
 }
@@ -0,0 +1,139 @@
+"""Compare the connectors' JSON codec with requests/json on EPD-sized payloads.
+
+Run from the connectors folder: python -m benchmarks.bench_codec
+
+The codec is timed with both of its backends: orjson, which the Lambda layer
+ships, and the standard json fallback, used wherever orjson cannot be
+imported. The fallback only gains from skipping the charset detection and text
+decoding of `response.json()`.
+"""
+import contextlib
+import json
+import random
+import timeit
+
+import requests
+
+from common import codec
+
+# ILCD process datasets are mostly long lists of exchanges and LCIA results.
+PAYLOAD_EXCHANGES = {"small": 50, "medium": 500, "large": 5000}
+REPEAT = 5
+
+
+def make_epd_payload(exchanges_count: int) -> bytes:
+    rng = random.Random(exchanges_count)
+    module_values = lambda: [  # noqa: E731
+        {"module": module, "value": f"{rng.uniform(-1e3, 1e3):.6E}"}
+        for module in ("A1-A3", "A4", "A5", "C1", "C2", "C3", "C4", "D")
+    ]
+    epd = {
+        "version": "1.1",
+        "processInformation": {
+            "dataSetInformation": {
+                "UUID": "9f6b5b1e-3f1a-4c8e-8f0e-0d6a0c1d2e3f",
+                "name": {"baseName": [{"lang": "de", "value": "Betonstahl, Stabstahl"}]},
+                "classificationInformation": {"classification": [{"class": [{"level": 0, "value": "Metalle"}]}]},
+            },
+        },
+        "exchanges": {
+            "exchange": [
+                {
+                    "dataSetInternalID": i,
+                    "referenceToFlowDataSet": {
+                        "refObjectId": f"{rng.getrandbits(128):032x}",
+                        "uri": f"../flows/{rng.getrandbits(128):032x}.xml",
+                        "shortDescription": [{"lang": "en", "value": f"Flow n°{i} – énergie primaire"}],
+                    },
+                    "exchangeDirection": rng.choice(["INPUT", "OUTPUT"]),
+                    "meanAmount": rng.random(),
+                    "other": {"anies": module_values()},
+                }
+                for i in range(exchanges_count)
+            ]
+        },
+        "LCIAResults": {
+            "LCIAResult": [
+                {"referenceToLCIAMethodDataSet": {"refObjectId": f"{i:032x}"}, "other": {"anies": module_values()}}
+                for i in range(max(10, exchanges_count // 20))
+            ]
+        },
+    }
+    return json.dumps(epd).encode("utf-8")
+
+
+def make_response(content: bytes, content_type: str) -> requests.Response:
+    response = requests.Response()
+    response.status_code = 200
+    response._content = content
+    if content_type:
+        response.headers["Content-Type"] = content_type
+    return response
+
+
+def best_of(statement) -> float:
+    return min(timeit.repeat(statement, number=1, repeat=REPEAT))
+
+
+@contextlib.contextmanager
+def fallback_backend():
+    """Run the codec on the standard json module, as without orjson."""
+    orjson, codec.orjson = codec.orjson, None
+    try:
+        yield
+    finally:
+        codec.orjson = orjson
+
+
+def format_timing(seconds: float, baseline_seconds: float) -> str:
+    return f"{seconds * 1000:>7.2f}ms {baseline_seconds / seconds:>6.1f}x"
+
+
+def main():
+    if codec.orjson is None:
+        print("orjson is not installed: only the json fallback is timed")
+    print(
+        f"{'payload':>8} {'size':>9} {'operation':<34} {'baseline':>9} "
+        f"{'json fallback':>17} {'orjson':>17}"
+    )
+    for name, exchanges_count in PAYLOAD_EXCHANGES.items():
+        payload = make_epd_payload(exchanges_count)
+        data = json.loads(payload)
+        cases = [
+            # requests sets utf-8 for application/json, then decodes to text first.
+            (
+                "decode, application/json",
+                lambda: make_response(payload, "application/json").json(),
+                lambda: codec.response_json(make_response(payload, "application/json")),
+            ),
+            # Without any charset, requests guesses the UTF flavour from the
+            # first bytes, and runs charset_normalizer if that guess fails.
+            (
+                "decode, no Content-Type",
+                lambda: make_response(payload, None).json(),
+                lambda: codec.response_json(make_response(payload, None)),
+            ),
+            (
+                "encode to bytes",
+                lambda: json.dumps(data).encode("utf-8"),
+                lambda: codec.dumps(data),
+            ),
+        ]
+        for operation, baseline, candidate in cases:
+            baseline_seconds = best_of(baseline)
+            with fallback_backend():
+                fallback_seconds = best_of(candidate)
+            orjson_timing = (
+                format_timing(best_of(candidate), baseline_seconds)
+                if codec.orjson is not None
+                else "n/a"
+            )
+            print(
+                f"{name:>8} {len(payload) / 1024:>7.0f}kB {operation:<34} "
+                f"{baseline_seconds * 1000:>7.2f}ms "
+                f"{format_timing(fallback_seconds, baseline_seconds):>17} {orjson_timing:>17}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+import logging
+import time
+from typing import Optional
+from uuid import uuid4
+
+from common import codec
+
+RETRY_ATTEMPTS_KEY = "retryAttempts"
+
+logger = logging.getLogger()
+
+
+def get_batch_data_from_s3(s3, bucket: str, batch: dict) -> tuple:
+    """Read the EPD infos of a batch item, a byte range of a JSONL object."""
+    start, end = batch["byteRange"]
+    response = s3.get_object(Bucket=bucket, Key=batch["s3Key"], Range=f"bytes={start}-{end}")
+    lines = response["Body"].read().splitlines()
+    return batch["batchId"], [codec.loads(line) for line in lines]
+
+
+def save_continuation_batch_to_s3(
+    s3, bucket: str, prefix: str, batch_id: int, epd_infos: list
+) -> dict:
+    """Write the records left when time ran out, as a batch item for the next iteration."""
+    s3_key = f"{prefix}{uuid4()}.jsonl"
+    body = b"".join(codec.dumps(epd_info) + b"\n" for epd_info in epd_infos)
+    s3.put_object(Bucket=bucket, Key=s3_key, Body=body, ContentType="application/x-ndjson")
+    return {"s3Key": s3_key, "batchId": batch_id, "byteRange": [0, len(body) - 1]}
+
+
+def save_retry_batch_to_s3(
+    s3, bucket: str, prefix: str, epd_infos: list, max_attempts: int
+) -> Optional[str]:
+    """Write the records to retry in a later run, and return the key of their batch.
+
+    Records already retried `max_attempts` times are given up on.
+    """
+    retry_infos = []
+    for epd_info in epd_infos:
+        attempts = epd_info.get(RETRY_ATTEMPTS_KEY, 0) + 1
+        if attempts > max_attempts:
+            logger.warning(
+                f"Giving up on EPD with UUID {epd_info['uuid']} after {attempts - 1} retries"
+            )
+            continue
+        retry_infos.append({**epd_info, RETRY_ATTEMPTS_KEY: attempts})
+    if not retry_infos:
+        return None
+
+    s3_key = f"{prefix}{uuid4()}.jsonl"
+    body = b"".join(codec.dumps(epd_info) + b"\n" for epd_info in retry_infos)
+    s3.put_object(Bucket=bucket, Key=s3_key, Body=body, ContentType="application/x-ndjson")
+    return s3_key
+
+
+def has_time_left(context, margin_ms: int) -> bool:
+    """Whether more than `margin_ms` is left before the Lambda timeout."""
+    return context is None or context.get_remaining_time_in_millis() > margin_ms
+
+
+def get_deadline(context, margin_ms: float) -> Optional[float]:
+    """`time.monotonic()` value `margin_ms` before the Lambda timeout, or None
+    outside of Lambda."""
+    if context is None:
+        return None
+    return time.monotonic() + (context.get_remaining_time_in_millis() - margin_ms) / 1000
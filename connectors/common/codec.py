@@ -0,0 +1,49 @@
+import json
+
+import requests
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# orjson is an optional extra, shipped in the Lambda layer as a manylinux
+# x86_64 wheel for Python 3.9. The standard json module is used wherever it
+# cannot be imported, as with another runtime or architecture.
+BACKEND = "orjson" if orjson is not None else "json"
+
+
+def loads(data):
+    """Decode JSON from UTF-8 bytes (or a str) with the fastest available backend."""
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # orjson rejects some documents the standard decoder accepts, like
+            # lone surrogate escapes, so it settles whether the body is invalid.
+            pass
+    return json.loads(data)
+
+
+def dumps(obj) -> bytes:
+    """Encode to compact UTF-8 JSON bytes, ready to be used as an S3 or HTTP body."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj)
+        except TypeError:
+            pass
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def response_json(response: requests.Response):
+    """Decode a response body as UTF-8 JSON, as RFC 8259 requires.
+
+    Unlike `response.json()`, the body is never decoded to text first, so no
+    charset detection runs when the server does not declare one.
+    """
+    try:
+        return loads(response.content)
+    except ValueError as e:
+        raise requests.exceptions.InvalidJSONError(
+            f"Invalid JSON from {response.url}: {e}", response=response
+        )
@@ -0,0 +1,81 @@
+import logging
+import os
+import threading
+import time
+
+import boto3
+import requests
+
+TOKEN_TTL = float(os.getenv("TOKEN_TTL_SECONDS", "900"))
+TOKEN_REFRESH_MARGIN = float(os.getenv("TOKEN_REFRESH_MARGIN_SECONDS", "60"))
+
+ssm = boto3.client("ssm", region_name="eu-west-3")
+
+logger = logging.getLogger()
+
+# Tokens live in module scope so that warm Lambda invocations, and every
+# record of a batch, share one SSM read per TTL instead of one per request.
+_tokens = {}
+_lock = threading.Lock()
+
+
+def get_parameter_token(parameter_name: str) -> str:
+    with _lock:
+        cached = _tokens.get(parameter_name)
+        # Refresh proactively, a margin before the cached token expires.
+        if cached is not None and time.monotonic() < cached[1] - TOKEN_REFRESH_MARGIN:
+            return cached[0]
+        return fetch_parameter_token(parameter_name)
+
+
+def refresh_parameter_token(parameter_name: str, stale_token: str) -> str:
+    """Re-read a token the server rejected, unless another thread already did."""
+    with _lock:
+        cached = _tokens.get(parameter_name)
+        if cached is not None and cached[0] != stale_token:
+            return cached[0]
+        return fetch_parameter_token(parameter_name)
+
+
+def fetch_parameter_token(parameter_name: str) -> str:
+    try:
+        response = ssm.get_parameter(Name=parameter_name, WithDecryption=False)
+    except Exception as e:
+        logger.error(f"Error retrieving API token: {e}")
+        raise e
+    token = response["Parameter"]["Value"]
+    _tokens[parameter_name] = (token, time.monotonic() + TOKEN_TTL)
+    return token
+
+
+class BearerTokenAuth(requests.auth.AuthBase):
+    """Bearer authentication from an SSM parameter, refreshed once on a 401."""
+
+    def __init__(self, parameter_name: str):
+        self.parameter_name = parameter_name
+
+    def __call__(self, request: requests.PreparedRequest) -> requests.PreparedRequest:
+        request.headers["Authorization"] = (
+            f"Bearer {get_parameter_token(self.parameter_name)}"
+        )
+        request.register_hook("response", self.handle_401)
+        return request
+
+    def handle_401(self, response: requests.Response, **kwargs) -> requests.Response:
+        if response.status_code != 401 or getattr(response.request, "token_refreshed", False):
+            return response
+
+        stale_token = response.request.headers["Authorization"][len("Bearer ") :]
+        token = refresh_parameter_token(self.parameter_name, stale_token)
+        logger.info(f"Retrying {response.request.url} with a refreshed token")
+
+        # Release the connection before re-sending on the same adapter.
+        response.content
+        response.close()
+        request = response.request.copy()
+        request.headers["Authorization"] = f"Bearer {token}"
+        request.token_refreshed = True
+        retried = response.connection.send(request, **kwargs)
+        retried.history.append(response)
+        retried.request = request
+        return retried
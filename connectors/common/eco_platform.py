@@ -0,0 +1,7 @@
+def get_pdf_url(uri: str, uuid: str, version: str) -> str:
+    """URL of the PDF document of an EPD, on the node serving its dataset `uri`."""
+    base_url = uri.split("resource/")[0] + "resource/processes"
+    url = f"{base_url}/{uuid}/epd"
+    if version:
+        url += f"?version={version}"
+    return url
@@ -0,0 +1,198 @@
+import logging
+import os
+import random
+import threading
+import time
+from typing import Optional
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from common import rate_limiter
+
+CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "60"))
+POOL_MAXSIZE = int(os.getenv("HTTP_POOL_MAXSIZE", "16"))
+MAX_RETRIES = int(os.getenv("HTTP_MAX_RETRIES", "3"))
+BACKOFF_BASE = float(os.getenv("HTTP_BACKOFF_BASE", "0.5"))
+BACKOFF_MAX = float(os.getenv("HTTP_BACKOFF_MAX", "30"))
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# Only requests that can safely be sent twice are retried by default.
+IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS", "PUT", "DELETE")
+
+logger = logging.getLogger()
+
+# Sessions live in module scope so that warm Lambda invocations keep reusing
+# the same keep-alive connections instead of paying a TCP+TLS handshake per call.
+_sessions = {}
+_default_headers = {}
+_stats = {}
+_lock = threading.Lock()
+
+
+def get_host(url: str) -> str:
+    return urlsplit(url).netloc.lower()
+
+
+def set_default_headers(host: str, headers: dict):
+    with _lock:
+        _default_headers[host] = dict(headers)
+        if host in _sessions:
+            _sessions[host].headers.update(headers)
+
+
+def get_session(url: str) -> requests.Session:
+    host = get_host(url)
+    with _lock:
+        if host not in _sessions:
+            _sessions[host] = create_session(host)
+        return _sessions[host]
+
+
+def create_session(host: str) -> requests.Session:
+    session = requests.Session()
+    # Threads beyond POOL_MAXSIZE open throwaway connections rather than wait
+    # for a free one: urllib3 has no bound on that wait, so one response left
+    # open would hold its slot, and hang a warm container, for good.
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_MAXSIZE)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update({"Connection": "keep-alive"})
+    session.headers.update(_default_headers.get(host, {}))
+    return session
+
+
+def request(
+    method: str, url: str, retries: int = None, deadline: float = None, **kwargs
+) -> requests.Response:
+    """Send a request, retried with exponential backoff on transient failures.
+
+    Connection errors, timeouts and RETRY_STATUSES responses are retried up to
+    `retries` times (MAX_RETRIES for idempotent methods, none otherwise). The
+    last response is returned as is, so callers still check its status.
+
+    With a `deadline`, a `time.monotonic()` value, no retry is started that
+    would wait past it and timeouts are cut to the time left.
+    """
+    if retries is None:
+        retries = MAX_RETRIES if method.upper() in IDEMPOTENT_METHODS else 0
+    timeout = kwargs.pop("timeout", (CONNECT_TIMEOUT, READ_TIMEOUT))
+    for attempt in range(retries + 1):
+        try:
+            response = send(method, url, timeout=get_timeout(timeout, deadline), **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            delay, reason = get_backoff(attempt), str(e)
+            if attempt >= retries or is_past(deadline, delay):
+                raise e
+        else:
+            if response.status_code not in RETRY_STATUSES or attempt >= retries:
+                return response
+            retry_after = rate_limiter.parse_retry_after(response.headers.get("Retry-After"))
+            if retry_after is not None and retry_after > BACKOFF_MAX:
+                return response
+            delay = max(get_backoff(attempt), retry_after or 0)
+            if is_past(deadline, delay):
+                return response
+            reason = f"HTTP {response.status_code}"
+            response.close()
+        logger.info(
+            f"Retrying {method} {url} in {delay:.1f}s ({attempt + 1}/{retries}): {reason}"
+        )
+        time.sleep(delay)
+
+
+def get_backoff(attempt: int) -> float:
+    # Full jitter spreads out the retries of threads that failed together.
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2**attempt))
+
+
+def get_timeout(timeout: tuple, deadline: float = None) -> tuple:
+    if deadline is None:
+        return timeout
+    if not isinstance(timeout, tuple):
+        timeout = (timeout, timeout)
+    time_left = deadline - time.monotonic()
+    if time_left <= 0:
+        raise requests.exceptions.Timeout("Deadline passed before the request was sent")
+    return tuple(min(value or time_left, time_left) for value in timeout)
+
+
+def get_time_left(deadline: float = None) -> Optional[float]:
+    """Seconds left before the deadline, or None without one, to wait on queues and futures."""
+    if deadline is None:
+        return None
+    return max(0.0, deadline - time.monotonic())
+
+
+def is_past(deadline: float, delay: float = 0) -> bool:
+    return deadline is not None and time.monotonic() + delay >= deadline
+
+
+def send(method: str, url: str, **kwargs) -> requests.Response:
+    kwargs.setdefault("timeout", (CONNECT_TIMEOUT, READ_TIMEOUT))
+    host = get_host(url)
+    limiter = rate_limiter.get_limiter(host)
+    if limiter is not None:
+        limiter.acquire()
+    start = time.monotonic()
+    try:
+        response = get_session(url).request(method, url, **kwargs)
+    except requests.exceptions.RequestException:
+        record_stats(host, time.monotonic() - start, error=True)
+        if limiter is not None:
+            limiter.record(None, time.monotonic() - start)
+        raise
+    if limiter is not None:
+        limiter.record(
+            response.status_code,
+            response.elapsed.total_seconds(),
+            response.headers.get("Retry-After"),
+        )
+
+    if kwargs.get("stream"):
+        size = int(response.headers.get("Content-Length", 0))
+    else:
+        size = len(response.content)
+    record_stats(host, time.monotonic() - start, size, error=response.status_code >= 400)
+    return response
+
+
+def get(url: str, **kwargs) -> requests.Response:
+    return request("GET", url, **kwargs)
+
+
+def post(url: str, **kwargs) -> requests.Response:
+    return request("POST", url, **kwargs)
+
+
+def record_stats(host: str, elapsed: float, size: int = 0, error: bool = False):
+    with _lock:
+        stats = _stats.setdefault(
+            host, {"requests": 0, "errors": 0, "bytes": 0, "seconds": 0.0}
+        )
+        stats["requests"] += 1
+        stats["errors"] += int(error)
+        stats["bytes"] += size
+        stats["seconds"] += elapsed
+
+
+def get_stats() -> dict:
+    with _lock:
+        return {host: dict(stats) for host, stats in _stats.items()}
+
+
+def log_stats():
+    for host, stats in get_stats().items():
+        average = stats["seconds"] / stats["requests"] if stats["requests"] else 0
+        limiter = rate_limiter.get_limiter(host)
+        rate = f", {limiter.rate:.1f} req/s allowed" if limiter is not None else ""
+        logger.info(
+            f"HTTP {host}: {stats['requests']} requests, {stats['errors']} errors, "
+            f"{stats['bytes']} bytes, {average:.3f}s average{rate}"
+        )
+
+
+def reset_stats():
+    with _lock:
+        _stats.clear()
@@ -0,0 +1,134 @@
+import logging
+import os
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "true").lower() == "true"
+# Requests per second allowed for a host before anything is known about it.
+RATE_LIMIT_INITIAL = float(os.getenv("RATE_LIMIT_INITIAL", "10"))
+RATE_LIMIT_MIN = float(os.getenv("RATE_LIMIT_MIN", "0.5"))
+RATE_LIMIT_MAX = float(os.getenv("RATE_LIMIT_MAX", "200"))
+# Requests that may be sent at once after an idle period.
+RATE_LIMIT_BURST = float(os.getenv("RATE_LIMIT_BURST", "5"))
+# Multiplicative decrease on throttling, additive increase (req/s gained per
+# second of healthy traffic) otherwise.
+THROTTLED_FACTOR = 0.5
+SLOW_FACTOR = 0.8
+INCREASE_PER_SECOND = float(os.getenv("RATE_LIMIT_INCREASE", "1"))
+# Latency above this multiple of the host's usual latency counts as overload.
+LATENCY_TOLERANCE = 2.0
+LATENCY_SMOOTHING = 0.2
+# Throttled responses already in flight when the rate was cut do not cut it again.
+DECREASE_COOLDOWN = 1.0
+THROTTLED_STATUSES = (429, 503)
+# Longer Retry-After delays are not honoured, as http_client does not wait
+# longer than its HTTP_BACKOFF_MAX either before giving up on a request.
+MAX_BLOCK = float(os.getenv("HTTP_BACKOFF_MAX", "30"))
+
+logger = logging.getLogger()
+
+_limiters = {}
+_lock = threading.Lock()
+
+
+class HostRateLimiter:
+    """Token bucket for one host, whose rate adapts to the host's responses.
+
+    The rate is halved on 429/503 responses and failed requests, honouring
+    `Retry-After` up to MAX_BLOCK, lowered when latency rises well above its usual value, and
+    raised back linearly while responses are healthy (AIMD). This converges on
+    the highest rate the host accepts. Thread-safe.
+    """
+
+    def __init__(self, host: str, rate: float = RATE_LIMIT_INITIAL):
+        self.host = host
+        self.rate = rate
+        self.tokens = min(RATE_LIMIT_BURST, rate)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.last_decrease = 0.0
+        self.latency = None
+        self.usual_latency = None
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Block until the host may be sent one more request."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.refill(now)
+                if now >= self.blocked_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = max(self.blocked_until - now, (1 - self.tokens) / self.rate)
+            time.sleep(wait)
+
+    def refill(self, now: float):
+        burst = max(1.0, min(RATE_LIMIT_BURST, self.rate))
+        self.tokens = min(burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def record(
+        self, status_code: Optional[int], elapsed: float, retry_after: str = None
+    ):
+        """Adapt the rate to a response, or to a failed request if `status_code` is None."""
+        with self.lock:
+            now = time.monotonic()
+            if status_code is None or status_code in THROTTLED_STATUSES:
+                delay = parse_retry_after(retry_after)
+                if delay:
+                    self.blocked_until = max(self.blocked_until, now + min(delay, MAX_BLOCK))
+                self.decrease(now, THROTTLED_FACTOR)
+                return
+
+            self.observe_latency(elapsed)
+            if self.latency > LATENCY_TOLERANCE * self.usual_latency:
+                self.decrease(now, SLOW_FACTOR)
+            elif status_code < 400:
+                # One request is 1 / rate seconds of traffic at the current rate.
+                self.rate = min(RATE_LIMIT_MAX, self.rate + INCREASE_PER_SECOND / self.rate)
+
+    def observe_latency(self, elapsed: float):
+        if self.latency is None:
+            self.latency = self.usual_latency = elapsed
+            return
+        self.latency += LATENCY_SMOOTHING * (elapsed - self.latency)
+        # The usual latency follows drops at once and rises only slowly, so a
+        # sustained slowdown stands out against it for a while.
+        if self.latency < self.usual_latency:
+            self.usual_latency = self.latency
+        else:
+            self.usual_latency += 0.01 * (self.latency - self.usual_latency)
+
+    def decrease(self, now: float, factor: float):
+        if now - self.last_decrease < DECREASE_COOLDOWN:
+            return
+        self.last_decrease = now
+        self.rate = max(RATE_LIMIT_MIN, self.rate * factor)
+        self.tokens = min(self.tokens, 0.0)
+        logger.info(f"Rate limit for {self.host} lowered to {self.rate:.2f} req/s")
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Seconds to wait from a Retry-After header, given as seconds or as an HTTP date."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def get_limiter(host: str) -> Optional[HostRateLimiter]:
+    if not RATE_LIMIT_ENABLED:
+        return None
+    with _lock:
+        if host not in _limiters:
+            _limiters[host] = HostRateLimiter(host)
+        return _limiters[host]
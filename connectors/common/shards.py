@@ -0,0 +1,151 @@
+import gzip
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, Optional
+
+from common import codec, storage
+
+SHARD_SUFFIX = ".jsonl.gz"
+INDEX_SUFFIX = ".index.json"
+SHARD_KEY = "shard"
+OFFSET_KEY = "offset"
+LENGTH_KEY = "length"
+
+
+class ShardWriter:
+    """Packs the EPDs of a batch into one gzip JSONL shard and its offset index.
+
+    Every record is compressed as its own gzip member: the concatenation is
+    still a valid gzip stream that can be read sequentially, and any record can
+    be fetched alone with a ranged GET of its `offset` and `length`.
+    """
+
+    def __init__(self, s3, bucket: str, prefix: str):
+        self.s3 = s3
+        self.bucket = bucket
+        name = f"{prefix}{uuid.uuid4()}"
+        self.s3_key = f"{name}{SHARD_SUFFIX}"
+        self.index_key = f"{name}{INDEX_SUFFIX}"
+        self.buffer = bytearray()
+        self.records = {}
+        self.lock = threading.Lock()
+
+    def write(self, id: str, body: bytes, metadata: dict):
+        member = storage.encode(body + b"\n", storage.GZIP)
+        with self.lock:
+            self.records[id] = {
+                **metadata,
+                OFFSET_KEY: len(self.buffer),
+                LENGTH_KEY: len(member),
+            }
+            self.buffer += member
+
+    def close(self) -> Optional[str]:
+        """Upload the shard and its index, and return the shard key if it has records."""
+        if not self.records:
+            return None
+        # The shard is written first, so an index never points to a missing shard.
+        self.s3.put_object(
+            Bucket=self.bucket,
+            Key=self.s3_key,
+            Body=bytes(self.buffer),
+            ContentType="application/gzip",
+        )
+        index = {SHARD_KEY: self.s3_key, "records": self.records}
+        self.s3.put_object(
+            Bucket=self.bucket,
+            Key=self.index_key,
+            Body=codec.dumps(index),
+            ContentType="application/json",
+        )
+        return self.s3_key
+
+
+def list_index_keys(s3, bucket: str, prefix: str) -> list:
+    """Keys of the shard indexes under `prefix`, oldest first."""
+    index_objects = []
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for content in page.get("Contents", []):
+            if content["Key"].endswith(INDEX_SUFFIX):
+                index_objects.append(content)
+    index_objects.sort(key=lambda content: content["LastModified"])
+    return [content["Key"] for content in index_objects]
+
+
+def read_shard_index(s3, bucket: str, key: str) -> dict:
+    """Read one index as uuid -> record entry, with the shard of each record."""
+    response = s3.get_object(Bucket=bucket, Key=key)
+    index = codec.loads(response["Body"].read())
+    # Entries of a compacted index carry their own shard.
+    return {
+        id: {SHARD_KEY: index[SHARD_KEY], **entry}
+        for id, entry in index["records"].items()
+    }
+
+
+def merge_shard_indexes(s3, bucket: str, keys: list, concurrency: int = 8) -> dict:
+    shard_index = {}
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for index in executor.map(lambda key: read_shard_index(s3, bucket, key), keys):
+            shard_index.update(index)
+    return shard_index
+
+
+def load_shard_index(s3, bucket: str, prefix: str, concurrency: int = 8) -> dict:
+    """Merge the indexes of every shard under `prefix` into uuid -> record entry.
+
+    Each entry holds the stored metadata of the record plus its shard, offset
+    and length. When a record was packed several times, the newest shard wins.
+    """
+    keys = list_index_keys(s3, bucket, prefix)
+    return merge_shard_indexes(s3, bucket, keys, concurrency)
+
+
+def compact_shard_indexes(s3, bucket: str, prefix: str, concurrency: int = 8) -> Optional[str]:
+    """Merge every index under `prefix` into one, and return its key.
+
+    The merged indexes are deleted, so that the next compaction only reads the
+    previous compacted index and the indexes of the shards written since.
+    """
+    keys = list_index_keys(s3, bucket, prefix)
+    if len(keys) <= 1:
+        return keys[0] if keys else None
+    index = {
+        SHARD_KEY: None,
+        "records": merge_shard_indexes(s3, bucket, keys, concurrency),
+    }
+    # The compacted index is written before the merged ones are deleted, so
+    # that no record is ever missing from the indexes.
+    compacted_key = f"{prefix}{uuid.uuid4()}{INDEX_SUFFIX}"
+    s3.put_object(
+        Bucket=bucket,
+        Key=compacted_key,
+        Body=codec.dumps(index),
+        ContentType="application/json",
+    )
+    for start in range(0, len(keys), 1000):
+        s3.delete_objects(
+            Bucket=bucket,
+            Delete={"Objects": [{"Key": key} for key in keys[start : start + 1000]]},
+        )
+    return compacted_key
+
+
+def read_shard_record(s3, bucket: str, entry: dict) -> dict:
+    """Fetch a single packed EPD with one ranged GET."""
+    start = entry[OFFSET_KEY]
+    end = start + entry[LENGTH_KEY] - 1
+    response = s3.get_object(
+        Bucket=bucket, Key=entry[SHARD_KEY], Range=f"bytes={start}-{end}"
+    )
+    return codec.loads(storage.decode(response["Body"].read(), storage.GZIP))
+
+
+def iter_shard_records(s3, bucket: str, shard_key: str) -> Iterator[dict]:
+    """Stream every EPD of a shard with a single GET."""
+    response = s3.get_object(Bucket=bucket, Key=shard_key)
+    with gzip.GzipFile(fileobj=response["Body"]) as lines:
+        for line in lines:
+            yield codec.loads(line)
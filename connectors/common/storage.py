@@ -0,0 +1,122 @@
+import gzip
+import os
+import zlib
+from typing import Iterable, Iterator
+
+from common import codec
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+NO_CODEC, GZIP, ZSTD = "none", "gzip", "zstd"
+CODECS = (NO_CODEC, GZIP, ZSTD)
+CODEC_KEY = "codec"
+# Fields that EPDs streamed as received only keep in their metadata, while
+# decoded EPDs also have them in their body.
+EPD_METADATA_FIELDS = ("uuid", "uri", "dataset_version", "pdf_url")
+EPD_STORAGE_CODEC = os.getenv("EPD_STORAGE_CODEC", NO_CODEC).lower()
+GZIP_LEVEL = int(os.getenv("EPD_STORAGE_GZIP_LEVEL", "6"))
+ZSTD_LEVEL = int(os.getenv("EPD_STORAGE_ZSTD_LEVEL", "9"))
+
+
+def check_codec(codec: str) -> str:
+    if codec not in CODECS:
+        raise ValueError(f"Unknown storage codec {codec!r}, expected one of {CODECS}")
+    if codec == ZSTD and zstandard is None:
+        raise ImportError("The zstd storage codec requires the zstandard package")
+    return codec
+
+
+def encode(body: bytes, codec: str = None) -> bytes:
+    codec = check_codec(codec or EPD_STORAGE_CODEC)
+    if codec == GZIP:
+        # mtime=0 keeps the output, and so the stored ETag, stable across runs.
+        return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+    if codec == ZSTD:
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(body)
+    return body
+
+
+def decode(body: bytes, codec: str) -> bytes:
+    codec = check_codec(codec or NO_CODEC)
+    if codec == GZIP:
+        return gzip.decompress(body)
+    if codec == ZSTD:
+        # Streamed frames have no content size in their header, which
+        # ZstdDecompressor.decompress() would need.
+        return zstandard.ZstdDecompressor().decompressobj().decompress(body)
+    return body
+
+
+def encode_chunks(chunks: Iterable[bytes], codec: str = None) -> Iterator[bytes]:
+    """Encode a stream of chunks with the configured codec, without buffering it."""
+    codec = check_codec(codec or EPD_STORAGE_CODEC)
+    if codec == NO_CODEC:
+        yield from chunks
+        return
+    if codec == GZIP:
+        # The gzip header written by zlib has mtime=0, like encode().
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+    else:
+        compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+class ChunksReader:
+    """File-like view of an iterator of chunks, for `upload_fileobj`."""
+
+    def __init__(self, chunks: Iterable[bytes]):
+        self.chunks = iter(chunks)
+        self.buffer = bytearray()
+
+    def read(self, size: int = -1) -> bytes:
+        while size < 0 or len(self.buffer) < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self.buffer += chunk
+        if size < 0:
+            size = len(self.buffer)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+
+def get_put_object_args(body: bytes, metadata: dict, codec: str = None) -> dict:
+    """Return the put_object arguments storing `body` with the configured codec."""
+    codec = check_codec(codec or EPD_STORAGE_CODEC)
+    args = {"Body": encode(body, codec), "Metadata": {**metadata, CODEC_KEY: codec}}
+    if codec != NO_CODEC:
+        args["ContentEncoding"] = codec
+    return args
+
+
+def get_object_codec(response: dict) -> str:
+    """Codec of a get_object or head_object response, written before codecs or not."""
+    return response["Metadata"].get(CODEC_KEY) or response.get("ContentEncoding") or NO_CODEC
+
+
+def read_object(s3, bucket: str, key: str) -> bytes:
+    response = s3.get_object(Bucket=bucket, Key=key)
+    return decode(response["Body"].read(), get_object_codec(response))
+
+
+def read_epd(s3, bucket: str, key: str) -> dict:
+    """Load a stored EPD whatever the codec and the way it was saved with.
+
+    EPDs streamed as received get the fields kept in their metadata back, so
+    that every EPD has the same shape.
+    """
+    response = s3.get_object(Bucket=bucket, Key=key)
+    epd = codec.loads(decode(response["Body"].read(), get_object_codec(response)))
+    for field in EPD_METADATA_FIELDS:
+        if field in response["Metadata"]:
+            epd.setdefault(field, response["Metadata"][field])
+    epd.setdefault("error", False)
+    return epd
@@ -0,0 +1,226 @@
+import argparse
+import gzip
+import io
+import json
+import logging
+import multiprocessing
+import os
+import re
+import time
+from collections import deque
+from multiprocessing.connection import wait
+
+import boto3
+
+try:
+    import pypdf
+except ImportError:
+    pypdf = None
+
+BUCKET_NAME = os.getenv("BUCKET_NAME")
+FOLDER_NAME = "eco"
+PDF_BY_UUID_PREFIX = f"pdfs/{FOLDER_NAME}/by-uuid/"
+CORPUS_KEY = f"corpus/{FOLDER_NAME}/pdf_texts.jsonl.gz"
+# Each document is extracted in its own process, killed when it takes longer
+# than this, so that one pathological PDF cannot hold a worker for the rest of
+# the run, nor a crash in the PDF parser end it.
+PDF_EXTRACTION_TIMEOUT = int(os.getenv("PDF_EXTRACTION_TIMEOUT", "60"))
+
+# Core and inventory indicators of EN 15804 result tables, most specific first.
+INDICATOR_PATTERN = re.compile(
+    r"^\s*(?P<indicator>"
+    r"GWP[- ](?:total|fossil|biogenic|luluc|GHG)|GWP"
+    r"|ODP|AP|EP[- ](?:freshwater|marine|terrestrial)|EP|POCP"
+    r"|ADP[- ](?:minerals ?& ?metals|fossil)|ADPE|ADPF|WDP"
+    r"|PERE|PERM|PERT|PENRE|PENRM|PENRT|SM|RSF|NRSF|FW"
+    r"|HWD|NHWD|RWD|CRU|MFR|MER|EEE|EET"
+    r")(?![\w-])(?P<rest>.*)$"
+)
+# Numbers standing alone, like "1.2E+02" or "-3,4", but not the 2 of "CO2".
+# A single separator is the decimal mark, and thousands separators are only
+# read as such when repeated or followed by the other decimal mark, as in
+# "1.234,5", "1,234.56" or "1.234.567".
+NUMBER_PATTERN = re.compile(
+    r"(?<![\w.,])[-+]?"
+    r"(?:\d{1,3}(?:,\d{3})+\.\d+|\d{1,3}(?:,\d{3}){2,}"
+    r"|\d{1,3}(?:\.\d{3})+,\d+|\d{1,3}(?:\.\d{3}){2,}"
+    r"|\d+(?:[.,]\d+)?)"
+    r"(?:[eE][-+]?\d+)?(?![\w]|[.,]\d)"
+)
+WHITESPACE_PATTERN = re.compile(r"[ \t\u00a0]+")
+
+logger = logging.getLogger()
+
+s3 = None
+
+
+def init_worker():
+    # boto3 clients must not be shared across forked processes.
+    global s3
+    s3 = boto3.client("s3")
+
+
+def list_pdf_pointers() -> list:
+    pointers = []
+    paginator = boto3.client("s3").get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=BUCKET_NAME, Prefix=PDF_BY_UUID_PREFIX):
+        pointers.extend(content["Key"] for content in page.get("Contents", []))
+    return pointers
+
+
+def parse_number(value: str) -> float:
+    """Read a number matched by NUMBER_PATTERN, whose last separator is the
+    decimal mark when there are two kinds of them."""
+    separators = [character for character in value if character in ".,"]
+    if len(separators) > 1:
+        value = value.replace(separators[0], "")
+    return float(value.replace(",", "."))
+
+
+def extract_indicators(page_number: int, text: str) -> list:
+    """Find the rows of indicator tables: an indicator, its unit, then its values."""
+    rows = []
+    for line in text.splitlines():
+        match = INDICATOR_PATTERN.match(line)
+        if not match:
+            continue
+        rest = match.group("rest")
+        numbers = list(NUMBER_PATTERN.finditer(rest))
+        if not numbers:
+            continue
+        rows.append(
+            {
+                "indicator": match.group("indicator"),
+                "unit": rest[: numbers[0].start()].strip(" :|") or None,
+                "values": [parse_number(number.group()) for number in numbers],
+                "page": page_number,
+            }
+        )
+    return rows
+
+
+def new_document(pointer_key: str, error: str = None) -> dict:
+    uuid, version = pointer_key[len(PDF_BY_UUID_PREFIX) : -len(".json")].split("/")
+    return {
+        "uuid": uuid,
+        "version": version,
+        "sha256": None,
+        "pages": [],
+        "indicators": [],
+        "error": error,
+    }
+
+
+def extract_pdf(pointer_key: str) -> dict:
+    """Extract the page texts and indicator rows of the PDF a pointer refers to."""
+    document = new_document(pointer_key)
+    try:
+        pointer = json.loads(
+            s3.get_object(Bucket=BUCKET_NAME, Key=pointer_key)["Body"].read()
+        )
+        document["sha256"] = pointer["sha256"]
+        data = s3.get_object(Bucket=BUCKET_NAME, Key=pointer["s3Key"])["Body"].read()
+        reader = pypdf.PdfReader(io.BytesIO(data))
+        for page_number, page in enumerate(reader.pages, start=1):
+            text = WHITESPACE_PATTERN.sub(" ", page.extract_text() or "").strip()
+            document["pages"].append(text)
+            document["indicators"] += extract_indicators(page_number, text)
+    except Exception as e:
+        document.update(pages=[], indicators=[], error=f"{type(e).__name__}: {e}")
+    return document
+
+
+def run_extraction(pointer_key: str, connection):
+    """Entry point of the process extracting one document, sent back on `connection`."""
+    init_worker()
+    connection.send(extract_pdf(pointer_key))
+    connection.close()
+
+
+def start_extraction(pointer_key: str) -> tuple:
+    """Start the process extracting a document, and return it with its result connection."""
+    connection, child_connection = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(
+        target=run_extraction, args=(pointer_key, child_connection), daemon=True
+    )
+    process.start()
+    # The connection only reports the end of a crashed process once no other
+    # process holds its sending end.
+    child_connection.close()
+    return process, connection
+
+
+def receive_document(process, connection, pointer_key: str) -> dict:
+    try:
+        return connection.recv()
+    except EOFError:
+        process.join()
+        return new_document(
+            pointer_key, f"Extraction process died with exit code {process.exitcode}"
+        )
+
+
+def write_document(output, document: dict, counts: dict):
+    output.write(json.dumps(document, ensure_ascii=False, separators=(",", ":")) + "\n")
+    counts["documents"] += 1
+    counts["pages"] += len(document["pages"])
+    counts["indicators"] += len(document["indicators"])
+    if document["error"]:
+        counts["errors"] += 1
+        logger.warning(f"Could not extract PDF of {document['uuid']}: {document['error']}")
+
+
+def extract_pdf_texts(output_path: str, workers: int = None, limit: int = None) -> dict:
+    """Write one JSON line per PDF (texts by page and indicator rows) to a gzip corpus."""
+    if pypdf is None:
+        raise ImportError("PDF text extraction requires the pypdf package")
+    pointers = deque(list_pdf_pointers()[:limit])
+    logger.info(f"Extracting the texts of {len(pointers)} PDFs")
+    workers = workers or os.cpu_count()
+    counts = {"documents": 0, "pages": 0, "indicators": 0, "errors": 0}
+    # Result connection -> (process, pointer key, deadline) of the documents in progress.
+    running = {}
+    with gzip.open(output_path, "wt", encoding="utf-8") as output:
+        while pointers or running:
+            while pointers and len(running) < workers:
+                pointer_key = pointers.popleft()
+                process, connection = start_extraction(pointer_key)
+                deadline = time.monotonic() + PDF_EXTRACTION_TIMEOUT
+                running[connection] = (process, pointer_key, deadline)
+
+            timeout = min(deadline for _, _, deadline in running.values()) - time.monotonic()
+            finished = {}
+            for connection in wait(list(running), max(0, timeout)):
+                process, pointer_key, _ = running[connection]
+                finished[connection] = receive_document(process, connection, pointer_key)
+            # Past its deadline, a process may be stuck in C code that no
+            # exception interrupts, so it is killed.
+            now = time.monotonic()
+            for connection, (_, pointer_key, deadline) in running.items():
+                if connection not in finished and deadline <= now:
+                    finished[connection] = new_document(
+                        pointer_key,
+                        f"TimeoutError: PDF extraction took more than {PDF_EXTRACTION_TIMEOUT}s",
+                    )
+
+            for connection, document in finished.items():
+                process = running.pop(connection)[0]
+                process.kill()
+                process.join()
+                connection.close()
+                write_document(output, document, counts)
+    logger.info(f"Extracted {counts}")
+    return counts
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Extract the texts of the stored EPD PDFs.")
+    parser.add_argument("--output", default="pdf_texts.jsonl.gz", help="Local corpus path")
+    parser.add_argument("--workers", type=int, help="Processes to use, all cores by default")
+    parser.add_argument("--limit", type=int, help="Only extract this many PDFs")
+    parser.add_argument("--upload", action="store_true", help=f"Also upload the corpus to {CORPUS_KEY}")
+    args = parser.parse_args()
+    extract_pdf_texts(args.output, args.workers, args.limit)
+    if args.upload:
+        boto3.client("s3").upload_file(args.output, BUCKET_NAME, CORPUS_KEY)
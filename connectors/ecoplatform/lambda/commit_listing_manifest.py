@@ -0,0 +1,35 @@
+import os
+import boto3
+import logging
+
+
+BUCKET_NAME = os.getenv("BUCKET_NAME")
+FOLDER_NAME = "eco"
+MANIFEST_KEY = f"manifests/{FOLDER_NAME}/listing.json"
+
+s3 = boto3.client("s3")
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+def lambda_handler(event: dict, context) -> dict:
+    """Make the manifest of a listing the current one.
+
+    The state machine only gets here once every batch of the listing was
+    processed, so the EPDs of a run that failed are batched again by the next
+    one instead of being taken as up to date.
+    """
+    pending_key = event.get("pendingManifestS3Key")
+    if not pending_key:
+        # Incomplete listings hand their batches over without a manifest.
+        logger.info("No listing manifest to commit")
+        return {"manifestCommitted": False}
+    s3.copy_object(
+        Bucket=BUCKET_NAME,
+        Key=MANIFEST_KEY,
+        CopySource={"Bucket": BUCKET_NAME, "Key": pending_key},
+    )
+    s3.delete_object(Bucket=BUCKET_NAME, Key=pending_key)
+    logger.info(f"Committed listing manifest {pending_key}")
+    return {"manifestCommitted": True}
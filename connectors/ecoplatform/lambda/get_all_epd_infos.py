@@ -1,102 +1,740 @@
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from contextlib import closing
 from datetime import datetime
+from typing import Iterator, Tuple
+import hashlib
 import logging
 import os
+import queue
+import threading
+import time
 import uuid
 import requests
 import boto3
-import json
+from botocore.exceptions import ClientError
 
-URL_EPD_INFOS = "https://data.eco-platform.org/resource/processes"
+from common import batches, codec, http_client, shards
+from common.credentials import BearerTokenAuth
+
+URL_ECO_PLATFORM = "https://data.eco-platform.org"
+URL_EPD_INFOS = f"{URL_ECO_PLATFORM}/resource/processes"
+URL_NODES = f"{URL_ECO_PLATFORM}/resource/nodes"
 UUID_KEY = "uuid"
 URI_KEY = "uri"
 EPD_VERSION_KEY = "version"
 
+API_TOKEN_PARAMETER = "/etl/ECOPLATFORM_TOKEN"
 BUCKET_NAME = os.getenv("BUCKET_NAME")
 FOLDER_NAME = "eco"
+LISTING_CONCURRENCY = int(os.getenv("LISTING_CONCURRENCY", "8"))
+LISTING_MODE = os.getenv("LISTING_MODE", "aggregator")
+ECO_PLATFORM_NODES = os.getenv("ECO_PLATFORM_NODES")
+LISTING_PAGE_SIZE = int(os.getenv("LISTING_PAGE_SIZE", "500"))
+LISTING_MIN_PAGE_SIZE = int(os.getenv("LISTING_MIN_PAGE_SIZE", "50"))
+LISTING_MAX_PAGE_SIZE = int(os.getenv("LISTING_MAX_PAGE_SIZE", "5000"))
+LISTING_LATENCY_BUDGET = float(os.getenv("LISTING_LATENCY_BUDGET", "10"))
+LISTING_MAX_PAGE_BYTES = int(os.getenv("LISTING_MAX_PAGE_BYTES", str(16 * 1024 * 1024)))
+LISTING_PAGE_ATTEMPTS = int(os.getenv("LISTING_PAGE_ATTEMPTS", "3"))
+LISTING_LEAN = os.getenv("LISTING_LEAN", "true").lower() == "true"
+STREAM_CHUNK_SIZE = 64 * 1024
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "1000"))
+BATCH_TARGET_SECONDS = float(os.getenv("BATCH_TARGET_SECONDS", "300"))
+DEFAULT_EPD_SECONDS = 1.5
+STORE_BYTES_PER_SECOND = 5 * 1024 * 1024
+# Records a get_epd_data worker processes at once, with the same default.
+EPD_FETCH_CONCURRENCY = int(os.getenv("EPD_FETCH_CONCURRENCY", "8"))
+COSTS_KEY = f"costs/{FOLDER_NAME}/epd_costs.json"
+COSTS_PARTS_PREFIX = f"costs/{FOLDER_NAME}/parts/"
+MANIFEST_KEY = f"manifests/{FOLDER_NAME}/listing.json"
+# A listing writes its manifest here, and the state machine only makes it the
+# current one once the batches of the listing were processed.
+PENDING_MANIFESTS_PREFIX = f"manifests/{FOLDER_NAME}/pending/"
+RETRIES_PREFIX = f"retries/{FOLDER_NAME}/"
+PDF_RETRIES_PREFIX = f"pdfs/{FOLDER_NAME}/retries/"
+SHARDS_PREFIX = f"shards/{FOLDER_NAME}/"
+CHECKPOINT_KEY = f"checkpoints/{FOLDER_NAME}/listing.json"
+LISTING_MAX_ATTEMPTS = int(os.getenv("LISTING_MAX_ATTEMPTS", "3"))
+# The listing checkpoints and asks to be resumed when less than this is left
+# before the Lambda timeout. Page fetches give up when half of it is left, and
+# the other half is kept to save the batches and the checkpoint.
+LISTING_TIME_MARGIN_MS = int(os.getenv("LISTING_TIME_MARGIN_SECONDS", "60")) * 1000
+MULTIPART_PART_SIZE = 8 * 1024 * 1024
+
+eco_platform_auth = BearerTokenAuth(API_TOKEN_PARAMETER)
 
 s3 = boto3.client("s3")
-ssm = boto3.client("ssm", region_name="eu-west-3")
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 
-def get_all_epd_infos() -> list:
-    headers = {"Authorization": f"Bearer {get_api_token()}"}
+class PageSizeTuner:
+    """Adapts the listing pageSize to the latency, payload size and caps of the node.
+
+    Pages grow while the node answers well within the latency budget, shrink
+    when it slows down past it or answers with errors, and never exceed the
+    pageSize the server actually honoured.
+    """
+
+    def __init__(
+        self,
+        page_size: int = LISTING_PAGE_SIZE,
+        min_page_size: int = LISTING_MIN_PAGE_SIZE,
+        max_page_size: int = LISTING_MAX_PAGE_SIZE,
+        latency_budget: float = LISTING_LATENCY_BUDGET,
+        max_page_bytes: int = LISTING_MAX_PAGE_BYTES,
+    ):
+        self.min_page_size = min_page_size
+        self.max_page_size = max_page_size
+        self.page_size = max(min_page_size, min(page_size, max_page_size))
+        self.latency_budget = latency_budget
+        self.max_page_bytes = max_page_bytes
+        self.lock = threading.Lock()
+
+    def observe(self, requested: int, returned: int, elapsed: float, size: int):
+        with self.lock:
+            if returned < requested:
+                # The server silently capped the page: never ask for more again.
+                self.max_page_size = max(self.min_page_size, returned)
+            if elapsed > self.latency_budget or size > self.max_page_bytes:
+                self.page_size = max(self.min_page_size, self.page_size // 2)
+            elif elapsed < self.latency_budget / 4 and size < self.max_page_bytes / 2:
+                self.page_size = self.page_size * 2
+            self.page_size = min(self.page_size, self.max_page_size)
+
+    def backoff(self):
+        with self.lock:
+            self.page_size = max(self.min_page_size, self.page_size // 2)
+
+
+def project_epd_infos(datas: list) -> list:
+    return [
+        {key: data[key] for key in [UUID_KEY, URI_KEY, EPD_VERSION_KEY]}
+        for data in datas
+    ]
+
+
+def get_epd_infos_page(
+    url: str,
+    params: dict,
+    start_index: int,
+    page_size: int,
+    tuner: PageSizeTuner,
+    deadline: float = None,
+) -> dict:
+    page_params = dict(params, startIndex=start_index, pageSize=page_size)
+    start = time.monotonic()
+    # Failed pages are retried by get_epd_infos_retried, with a smaller page size.
+    # The response is closed on every path, so that its connection goes back
+    # to the pool even when the page fails.
+    with http_client.get(
+        url,
+        params=page_params,
+        auth=eco_platform_auth,
+        stream=True,
+        retries=0,
+        deadline=deadline,
+    ) as response:
+        response.raise_for_status()
+        chunks = []
+        for chunk in response.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+            if http_client.is_past(deadline):
+                raise requests.exceptions.Timeout(
+                    f"Deadline passed while reading EPD infos at index {start_index}"
+                )
+            chunks.append(chunk)
+    body = b"".join(chunks)
+
+    # Lean pages are small enough to be decoded whole, which the C decoders do
+    # faster than any incremental extraction. Records are reduced to
+    # uuid/uri/version right away.
+    try:
+        json_response = codec.loads(body)
+        json_response["data"] = project_epd_infos(json_response["data"])
+        returned_page_size = json_response["pageSize"]
+    except (ValueError, KeyError, TypeError) as e:
+        raise requests.exceptions.InvalidJSONError(
+            f"Invalid EPD infos page at index {start_index}: {e!r}", response=response
+        )
+    tuner.observe(page_size, returned_page_size, time.monotonic() - start, len(body))
+    return json_response
+
+
+def get_epd_infos_retried(
+    url: str,
+    params: dict,
+    start_index: int,
+    count: int,
+    tuner: PageSizeTuner,
+    deadline: float = None,
+) -> dict:
+    """Fetch a page of at most `count` records, retried with backoff and a smaller pageSize."""
+    attempt = 0
+    while True:
+        page_size = min(tuner.page_size, count)
+        try:
+            return get_epd_infos_page(url, params, start_index, page_size, tuner, deadline)
+        except requests.exceptions.RequestException as e:
+            attempt += 1
+            delay = http_client.get_backoff(attempt)
+            if attempt >= LISTING_PAGE_ATTEMPTS or http_client.is_past(deadline, delay):
+                raise e
+            tuner.backoff()
+            logger.info(
+                f"Retrying EPD infos at index {start_index} with pageSize "
+                f"{tuner.page_size} in {delay:.1f}s: {e}"
+            )
+            time.sleep(delay)
+
+
+def get_epd_infos_range(
+    url: str,
+    params: dict,
+    start_index: int,
+    count: int,
+    tuner: PageSizeTuner,
+    deadline: float = None,
+) -> list:
+    """Fetch the `count` records from `start_index`, in as many pages as the node needs."""
+    datas = []
+    while len(datas) < count:
+        json_response = get_epd_infos_retried(
+            url, params, start_index + len(datas), count - len(datas), tuner, deadline
+        )
+        if not json_response["data"]:
+            break
+        datas += json_response["data"]
+    return datas
+
+
+def get_page_result(future: Future, deadline: float = None):
+    """Wait for the result of a page fetch, but not past the deadline."""
+    try:
+        return future.result(timeout=http_client.get_time_left(deadline))
+    except FutureTimeoutError:
+        raise requests.exceptions.Timeout("Deadline passed while waiting for EPD infos")
+
+
+def iter_epd_info_pages(
+    concurrency: int = LISTING_CONCURRENCY,
+    start_index: int = 0,
+    url: str = URL_EPD_INFOS,
+    distributed: bool = True,
+    deadline: float = None,
+) -> Iterator[Tuple[int, list]]:
+    """Yield (next startIndex, projected EPD infos) for each page of `url` from `start_index`.
+
+    Raises the underlying RequestException when a page cannot be fetched, or
+    a Timeout once `deadline` passed, so that the caller can checkpoint the
+    cursor and resume later.
+    """
     current_year = datetime.now().year
     params = {
         "search": "true",
         "format": "json",
-        "distributed": "true",
+        "distributed": "true" if distributed else "false",
         "virtual": "true",
-        "metaDataOnly": "false",
+        "metaDataOnly": "true" if LISTING_LEAN else "false",
         "validUntil": current_year,
     }
+    tuner = PageSizeTuner()
+    concurrency = max(1, concurrency)
+    # Pages are fetched in the pool and waited for with the deadline, so that
+    # a fetch that overruns it never holds up the checkpoint.
+    executor = ThreadPoolExecutor(max_workers=concurrency)
     try:
-        response = requests.get(URL_EPD_INFOS, headers=headers, params=params)
+        try:
+            json_response = get_page_result(
+                executor.submit(
+                    get_epd_infos_retried,
+                    url,
+                    params,
+                    start_index,
+                    tuner.page_size,
+                    tuner,
+                    deadline,
+                ),
+                deadline,
+            )
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Error while getting EPD infos from {url} at index {start_index}: {e}")
+            raise e
+
+        total_count = json_response["totalCount"]
+        next_index = start_index + len(json_response["data"])
+        logger.info(
+            f"Retrieved initial page of {url} with {len(json_response['data'])} of "
+            f"{total_count} records, fetching the rest with concurrency {concurrency}."
+        )
+        yield next_index, json_response["data"]
+
+        # The first page tells us the catalogue size, so the following ranges are
+        # fetched concurrently, each sized from the tuner at submission time. Only
+        # `concurrency` ranges are in flight at once and they are yielded in index
+        # order, which keeps memory bounded.
+        pending = deque()
+        while True:
+            while next_index < total_count and len(pending) < concurrency:
+                count = min(tuner.page_size, total_count - next_index)
+                future = executor.submit(
+                    get_epd_infos_range, url, params, next_index, count, tuner, deadline
+                )
+                pending.append((next_index, count, future))
+                next_index += count
+            if not pending:
+                break
+
+            range_start, count, future = pending.popleft()
+            try:
+                datas = get_page_result(future, deadline)
+            except requests.exceptions.RequestException as e:
+                logger.warning(
+                    f"Error while getting EPD infos from {url} at index {range_start}: {e}"
+                )
+                raise e
+            yield range_start + count, datas
+    finally:
+        # Ranges not started are dropped, and those in flight are not waited
+        # for: they give up by the deadline on their own.
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    logger.info(f"Listing of {url} finished with pageSize {tuner.page_size}")
+
+
+def discover_nodes() -> list:
+    """Return the base URLs of the member nodes behind the eco-platform aggregator."""
+    if ECO_PLATFORM_NODES:
+        base_urls = [
+            node.strip().rstrip("/") for node in ECO_PLATFORM_NODES.split(",") if node.strip()
+        ]
+    else:
+        response = http_client.get(URL_NODES, params={"format": "json"})
         response.raise_for_status()
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Error while getting all EPDs infos: {e}")
-        raise e
+        json_response = codec.response_json(response)
+        nodes = json_response.get("data", json_response.get("nodes", []))
+        base_urls = []
+        for node in nodes:
+            base_url = node.get("baseURL") or node.get("baseUrl") or node.get("url")
+            if base_url:
+                base_urls.append(base_url.split("/resource")[0].rstrip("/"))
+    # An empty listing would be taken for an empty catalogue, and its manifest
+    # would have every EPD batched again by the next run.
+    if not base_urls:
+        raise ValueError("No eco-platform nodes to list")
+    logger.info(f"Discovered {len(base_urls)} nodes: {base_urls}")
+    return base_urls
 
-    json_response = response.json()
-    datas = json_response["data"]
-    total_count = json_response["totalCount"]
-    page_size = json_response["pageSize"]
-    start_index = json_response["startIndex"] + page_size
 
-    logger.info(f"Retrieved initial page with {len(datas)} records.")
+def iter_listing_pages(
+    checkpoint: dict, concurrency: int, deadline: float = None
+) -> Iterator[Tuple[str, int, list]]:
+    """Yield (source URL, next startIndex, EPD infos) for each listed page.
 
-    while start_index < total_count:
-        params["startIndex"] = start_index
-        response = requests.get(URL_EPD_INFOS, headers=headers, params=params)
+    In "aggregator" mode the distributed eco-platform listing is walked. In
+    "nodes" mode each member node is listed directly in its own thread, so
+    that the aggregator's fan-out no longer gates the crawl; pages are yielded
+    as they arrive and node failures are raised once every node is done.
+    """
+    cursors = checkpoint["cursors"]
+    if checkpoint["listingMode"] != "nodes":
+        for next_start_index, epd_infos in iter_epd_info_pages(
+            concurrency, cursors.get(URL_EPD_INFOS, 0), URL_EPD_INFOS, deadline=deadline
+        ):
+            yield URL_EPD_INFOS, next_start_index, epd_infos
+        return
 
+    if not checkpoint["nodes"]:
+        raise ValueError("No eco-platform nodes to list")
+    urls = [f"{node}/resource/processes" for node in checkpoint["nodes"]]
+    pages = queue.Queue(maxsize=2 * len(urls))
+    # Set when the consumer stops early, so that no node thread stays blocked
+    # on a full queue.
+    stopped = threading.Event()
+
+    def put_page(page: tuple) -> bool:
+        while not stopped.is_set():
+            try:
+                pages.put(page, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def list_node(url: str):
+        # Every thread ends with a sentinel, or the consumer would wait forever.
         try:
-            response = requests.get(URL_EPD_INFOS, headers=headers, params=params)
-            response.raise_for_status()
-        except requests.exceptions.RequestException as e:
-            logger.warning(f"Error while getting EPD infos at index {start_index}: {e}")
-            return datas
+            for next_start_index, epd_infos in iter_epd_info_pages(
+                concurrency, cursors.get(url, 0), url, distributed=False, deadline=deadline
+            ):
+                if not put_page((url, next_start_index, epd_infos)):
+                    return
+            put_page((url, None, None))
+        except Exception as e:
+            put_page((url, e, None))
 
-        json_response = response.json()
-        datas += json_response["data"]
-        start_index = json_response["startIndex"] + page_size
+    for url in urls:
+        threading.Thread(target=list_node, args=(url,), daemon=True).start()
 
-    epd_infos = [
-        {key: data[key] for key in [UUID_KEY, URI_KEY, EPD_VERSION_KEY]}
-        for data in datas
+    remaining, errors = len(urls), []
+    try:
+        while remaining:
+            try:
+                url, next_start_index, epd_infos = pages.get(
+                    timeout=http_client.get_time_left(deadline)
+                )
+            except queue.Empty:
+                raise requests.exceptions.Timeout("Deadline passed while waiting for node pages")
+            if epd_infos is None:
+                remaining -= 1
+                if next_start_index is not None:
+                    errors.append(next_start_index)
+                continue
+            yield url, next_start_index, epd_infos
+    finally:
+        stopped.set()
+    if errors:
+        raise errors[0]
+
+
+class BatchFileWriter:
+    """Writes every batch of a listing invocation as lines of one JSONL object.
+
+    The object is streamed with a multipart upload, and each batch is handed to
+    the Map state as a byte range of that object that workers read with a
+    ranged GET.
+    """
+
+    def __init__(self):
+        self.s3_key = f"batches/{FOLDER_NAME}/{uuid.uuid4()}.jsonl"
+        self.upload_id = None
+        self.parts = []
+        self.buffer = bytearray()
+        self.offset = 0
+
+    def write_batch(self, batch_id: int, epd_infos: list, estimated_seconds: float) -> dict:
+        start = self.offset
+        for epd_info in epd_infos:
+            line = codec.dumps(epd_info) + b"\n"
+            self.buffer += line
+            self.offset += len(line)
+        if len(self.buffer) >= MULTIPART_PART_SIZE:
+            self.upload_part()
+        return {
+            "s3Key": self.s3_key,
+            "batchId": batch_id,
+            "byteRange": [start, self.offset - 1],
+            "estimatedSeconds": round(estimated_seconds, 1),
+        }
+
+    def upload_part(self):
+        if self.upload_id is None:
+            response = s3.create_multipart_upload(
+                Bucket=BUCKET_NAME, Key=self.s3_key, ContentType="application/x-ndjson"
+            )
+            self.upload_id = response["UploadId"]
+        part_number = len(self.parts) + 1
+        response = s3.upload_part(
+            Bucket=BUCKET_NAME,
+            Key=self.s3_key,
+            UploadId=self.upload_id,
+            PartNumber=part_number,
+            Body=bytes(self.buffer),
+        )
+        self.parts.append({"PartNumber": part_number, "ETag": response["ETag"]})
+        self.buffer = bytearray()
+
+    def close(self):
+        if self.upload_id is None:
+            if self.buffer:
+                s3.put_object(
+                    Bucket=BUCKET_NAME,
+                    Key=self.s3_key,
+                    Body=bytes(self.buffer),
+                    ContentType="application/x-ndjson",
+                )
+            return
+        if self.buffer:
+            self.upload_part()
+        s3.complete_multipart_upload(
+            Bucket=BUCKET_NAME,
+            Key=self.s3_key,
+            UploadId=self.upload_id,
+            MultipartUpload={"Parts": self.parts},
+        )
+
+
+class EpdCostEstimator:
+    """Estimates how much time an EPD adds to the batch of a worker.
+
+    Uses the bytes and fetch latency recorded for the EPD by previous runs,
+    falling back to the average of its host, then to DEFAULT_EPD_SECONDS.
+    Workers process `concurrency` EPDs at once, so each one only adds that
+    share of its own duration.
+    """
+
+    def __init__(self, costs: dict, concurrency: int = EPD_FETCH_CONCURRENCY):
+        self.costs = costs
+        self.concurrency = max(1, concurrency)
+        host_totals = {}
+        for cost in costs.values():
+            totals = host_totals.setdefault(cost[2], [0, 0.0])
+            totals[0] += 1
+            totals[1] += self.get_seconds(cost)
+        self.host_seconds = {
+            host: total_seconds / count for host, (count, total_seconds) in host_totals.items()
+        }
+
+    @staticmethod
+    def get_seconds(cost: list) -> float:
+        size, latency, _ = cost
+        return latency + size / STORE_BYTES_PER_SECOND
+
+    def estimate(self, epd_info: dict) -> float:
+        cost = self.costs.get(epd_info[UUID_KEY])
+        if cost is not None:
+            seconds = self.get_seconds(cost)
+        else:
+            host = http_client.get_host(epd_info[URI_KEY])
+            seconds = self.host_seconds.get(host, DEFAULT_EPD_SECONDS)
+        return seconds / self.concurrency
+
+
+def load_epd_costs() -> dict:
+    """Load the recorded uuid -> [bytes, seconds, host] costs, merging the parts
+    written by get_epd_data workers since the previous listing."""
+    try:
+        response = s3.get_object(Bucket=BUCKET_NAME, Key=COSTS_KEY)
+        costs = codec.loads(response["Body"].read())
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "NoSuchKey":
+            raise e
+        costs = {}
+
+    paginator = s3.get_paginator("list_objects_v2")
+    part_keys = [
+        content["Key"]
+        for page in paginator.paginate(Bucket=BUCKET_NAME, Prefix=COSTS_PARTS_PREFIX)
+        for content in page.get("Contents", [])
     ]
-    logger.info(f"Total EPD infos retrieved: {len(epd_infos)}")
-    return epd_infos
+    for key in part_keys:
+        response = s3.get_object(Bucket=BUCKET_NAME, Key=key)
+        costs.update(codec.loads(response["Body"].read()))
+    if part_keys:
+        s3.put_object(Bucket=BUCKET_NAME, Key=COSTS_KEY, Body=codec.dumps(costs))
+        for key in part_keys:
+            s3.delete_object(Bucket=BUCKET_NAME, Key=key)
+    return costs
 
 
-def get_api_token() -> str:
-    parameter_name = "/etl/ECOPLATFORM_TOKEN"
+def load_listing_manifest() -> dict:
     try:
-        response = ssm.get_parameter(Name=parameter_name, WithDecryption=False)
-        return response["Parameter"]["Value"]
-    except Exception as e:
-        logger.error(f"Error retrieving API token: {e}")
+        response = s3.get_object(Bucket=BUCKET_NAME, Key=MANIFEST_KEY)
+    except ClientError as e:
+        if e.response["Error"]["Code"] == "NoSuchKey":
+            return {"fingerprint": None, "versions": {}}
+        raise e
+    return codec.loads(response["Body"].read())
+
+
+def get_listing_fingerprint(versions: dict) -> str:
+    digest = hashlib.sha256()
+    for epd_uuid, version in sorted(versions.items()):
+        digest.update(f"{epd_uuid}:{version}\n".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def save_pending_listing_manifest(versions: dict) -> Tuple[str, str]:
+    """Save the manifest of a listing until it is committed, and return its fingerprint and key."""
+    fingerprint = get_listing_fingerprint(versions)
+    manifest = {
+        "fingerprint": fingerprint,
+        "generatedAt": datetime.now().isoformat(),
+        "versions": versions,
+    }
+    s3_key = f"{PENDING_MANIFESTS_PREFIX}{uuid.uuid4()}.json"
+    s3.put_object(Bucket=BUCKET_NAME, Key=s3_key, Body=codec.dumps(manifest))
+    return fingerprint, s3_key
+
+
+def load_listing_checkpoint() -> dict:
+    try:
+        response = s3.get_object(Bucket=BUCKET_NAME, Key=CHECKPOINT_KEY)
+    except ClientError as e:
+        if e.response["Error"]["Code"] == "NoSuchKey":
+            return None
         raise e
+    return codec.loads(response["Body"].read())
+
+
+def save_listing_checkpoint(checkpoint: dict):
+    s3.put_object(Bucket=BUCKET_NAME, Key=CHECKPOINT_KEY, Body=codec.dumps(checkpoint))
+
+
+def remove_listing_checkpoint():
+    s3.delete_object(Bucket=BUCKET_NAME, Key=CHECKPOINT_KEY)
+
+
+def list_retry_batches(first_batch_id: int) -> list:
+    """Batch items for the EPDs whose data or PDF still failed at the end of previous runs.
+
+    Their versions are committed to the listing manifest with the rest of the
+    run, so they would never be batched again otherwise. Workers delete a retry batch once processed.
+    """
+    batches = []
+    paginator = s3.get_paginator("list_objects_v2")
+    # Each worker skips the retry batches of the other one.
+    for prefix, flag in ((RETRIES_PREFIX, "retryBatch"), (PDF_RETRIES_PREFIX, "pdfRetryBatch")):
+        for page in paginator.paginate(Bucket=BUCKET_NAME, Prefix=prefix):
+            for content in page.get("Contents", []):
+                if not content["Size"]:
+                    continue
+                batches.append(
+                    {
+                        "s3Key": content["Key"],
+                        "batchId": first_batch_id + len(batches),
+                        "byteRange": [0, content["Size"] - 1],
+                        flag: True,
+                    }
+                )
+    return batches
 
 
-def upload_batch_to_s3(batch_data):
-    batch_id = str(uuid.uuid4())
-    s3_key = f"batches/{FOLDER_NAME}/{batch_id}.json"
-    s3.put_object(Bucket=BUCKET_NAME, Key=s3_key, Body=json.dumps(batch_data))
-    return {"s3Key": s3_key}
+def add_shard_index(batch_items: list) -> list:
+    """Point the batch items to one compacted index of the packed EPDs.
 
+    Workers then read a single object instead of every shard index ever
+    written, for each batch and each continuation.
+    """
+    if not batch_items:
+        return batch_items
+    index_key = shards.compact_shard_indexes(s3, BUCKET_NAME, SHARDS_PREFIX)
+    if index_key is None:
+        return batch_items
+    return [dict(batch_item, shardIndexS3Key=index_key) for batch_item in batch_items]
 
-def lambda_handler(event, context) -> list:
-    epd_infos = get_all_epd_infos()
-    batch_size = 200
-    s3_keys = []
-    for i in range(0, len(epd_infos), batch_size):
-        curr_batch_size = min(batch_size, len(epd_infos) - i)
-        batch_data = {
-            "batchId": i // batch_size,
-            "epdInfos": epd_infos[i : i + curr_batch_size],
+
+def lambda_handler(event, context) -> dict:
+    http_client.reset_stats()
+    concurrency = event.get("listingConcurrency", LISTING_CONCURRENCY)
+    # Failed invocations, after which the batches are handed over anyway.
+    attempt = event.get("listingAttempt", 0)
+    checkpoint = load_listing_checkpoint()
+    if checkpoint is None:
+        listing_mode = event.get("listingMode", LISTING_MODE)
+        checkpoint = {
+            "listingMode": listing_mode,
+            "nodes": discover_nodes() if listing_mode == "nodes" else [],
+            "cursors": {},
+            "pagesDone": 0,
+            "batchKeys": [],
+            "versions": {},
+            "fullListing": bool(event.get("fullListing")),
         }
-        s3_keys.append(upload_batch_to_s3(batch_data))
+    else:
+        logger.info(
+            f"Resuming {checkpoint['listingMode']} listing at {checkpoint['cursors']} after "
+            f"{checkpoint['pagesDone']} pages and {len(checkpoint['batchKeys'])} batches"
+        )
+
+    # Only EPDs that are new or have a new version since the previous run are
+    # batched, unless a full listing is explicitly requested.
+    if checkpoint["fullListing"]:
+        previous_versions = {}
+    else:
+        previous_versions = load_listing_manifest()["versions"]
+
+    # Batches are packed to a target duration from the recorded per-EPD costs,
+    # so that Map workers finish at roughly the same time.
+    estimator = EpdCostEstimator(load_epd_costs())
+
+    s3_keys, versions = checkpoint["batchKeys"], checkpoint["versions"]
+    batch, batch_cost = [], 0.0
+    writer = BatchFileWriter()
+    error, out_of_time = None, False
+    deadline = batches.get_deadline(context, LISTING_TIME_MARGIN_MS / 2)
+    try:
+        with closing(iter_listing_pages(checkpoint, concurrency, deadline)) as pages:
+            for url, next_start_index, epd_infos in pages:
+                for epd_info in epd_infos:
+                    epd_uuid, version = epd_info[UUID_KEY], epd_info[EPD_VERSION_KEY]
+                    # The same uuid+version may be listed by several nodes.
+                    if versions.get(epd_uuid) == version:
+                        continue
+                    versions[epd_uuid] = version
+                    if previous_versions.get(epd_uuid) == version:
+                        continue
+                    batch.append(epd_info)
+                    batch_cost += estimator.estimate(epd_info)
+                    if batch_cost >= BATCH_TARGET_SECONDS or len(batch) >= MAX_BATCH_SIZE:
+                        s3_keys.append(writer.write_batch(len(s3_keys), batch, batch_cost))
+                        batch, batch_cost = [], 0.0
+                checkpoint["cursors"][url] = next_start_index
+                checkpoint["pagesDone"] += 1
+                # Stopping before the Lambda timeout keeps the pages listed so far.
+                if not batches.has_time_left(context, LISTING_TIME_MARGIN_MS):
+                    out_of_time = True
+                    break
+    except Exception as e:
+        # Pages cut short by the deadline are listed again on resume, like
+        # those of a paused listing, without counting as a failed attempt.
+        if http_client.is_past(deadline):
+            out_of_time = True
+        else:
+            error = e
 
-    return {"inputBatchesS3Keys": s3_keys}
+    if error is not None or out_of_time:
+        # Everything before each cursor is already in batch objects, so the
+        # next invocation can pick up exactly at checkpoint["cursors"].
+        if batch:
+            s3_keys.append(writer.write_batch(len(s3_keys), batch, batch_cost))
+        writer.close()
+        if error is not None:
+            attempt += 1
+            logger.warning(
+                f"Listing interrupted at {checkpoint['cursors']} "
+                f"(attempt {attempt}/{LISTING_MAX_ATTEMPTS}): {error}"
+            )
+        else:
+            logger.info(f"Listing paused at {checkpoint['cursors']} to stay within the Lambda timeout")
+        resume_listing = attempt < LISTING_MAX_ATTEMPTS
+        if not resume_listing:
+            # Hand the batches over now; a later execution resumes the cursor.
+            # Their versions are dropped too: the manifest of that execution
+            # must not take them as processed, in case this one fails.
+            checkpoint["batchKeys"] = []
+            checkpoint["versions"] = {}
+        save_listing_checkpoint(checkpoint)
+        http_client.log_stats()
+        return {
+            "inputBatchesS3Keys": [] if resume_listing else add_shard_index(s3_keys),
+            "pendingManifestS3Key": None,
+            "listingComplete": False,
+            "resumeListing": resume_listing,
+            "listingAttempt": attempt,
+        }
+
+    if batch:
+        s3_keys.append(writer.write_batch(len(s3_keys), batch, batch_cost))
+    writer.close()
+
+    fingerprint, manifest_key = save_pending_listing_manifest(versions)
+    remove_listing_checkpoint()
+    retry_batches = list_retry_batches(len(s3_keys))
+    logger.info(
+        f"Total EPD infos retrieved: {len(versions)}, "
+        f"{len(s3_keys)} batches of new or updated EPDs and {len(retry_batches)} retry batches, "
+        f"listing fingerprint {fingerprint}"
+    )
+    s3_keys += retry_batches
+    http_client.log_stats()
+
+    return {
+        "inputBatchesS3Keys": add_shard_index(s3_keys),
+        "listingFingerprint": fingerprint,
+        "pendingManifestS3Key": manifest_key,
+        "listingComplete": True,
+        "resumeListing": False,
+        "listingAttempt": attempt,
+    }
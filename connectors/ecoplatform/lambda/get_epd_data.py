@@ -1,10 +1,24 @@
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import itertools
 import json
 import os
-import requests
+import time
+import zlib
+from typing import Callable, Iterable, Iterator, Optional
+from uuid import uuid4
 import boto3
+import requests
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 from botocore.exceptions import ClientError
 import logging
 
+from common import batches, codec, http_client, shards, storage
+from common.eco_platform import get_pdf_url
+from common.credentials import BearerTokenAuth
+
 
 URL_EPD_INFOS = "https://data.eco-platform.org/resource/processes"
 UUID_KEY = "uuid"
@@ -13,36 +27,106 @@ DATASET_VERSION_KEY = "dataset_version"
 EPD_VERSION_KEY = "version"
 PDF_URL_KEY = "pdf_url"
 ERROR_KEY = "error"
+CONTENT_SHA256_KEY = "content_sha256"
+ETAG_KEY = "upstream_etag"
+LAST_MODIFIED_KEY = "upstream_last_modified"
+CREATED, UPDATED, UNCHANGED = "created", "updated", "unchanged"
+DEFERRED = "deferred"
+API_TOKEN_PARAMETER = "/etl/ECOPLATFORM_TOKEN"
 BUCKET_NAME = os.getenv("BUCKET_NAME")
 FOLDER_NAME = "eco"
+EPD_FETCH_CONCURRENCY = int(os.getenv("EPD_FETCH_CONCURRENCY", "8"))
+# Revalidate every stored EPD with a conditional GET, even when its listed
+# version is unchanged.
+EPD_REFRESH = os.getenv("EPD_REFRESH", "false").lower() == "true"
+# "objects" saves each EPD as eco/<uuid>.json, "packed" writes one gzip JSONL
+# shard per batch with a uuid -> (offset, length) index.
+OBJECTS_MODE, PACKED_MODE = "objects", "packed"
+EPD_OUTPUT_MODE = os.getenv("EPD_OUTPUT_MODE", OBJECTS_MODE)
+BATCHES_PREFIX = f"batches/{FOLDER_NAME}/"
+SHARDS_PREFIX = f"shards/{FOLDER_NAME}/"
+# Saved objects hold the upstream body as received, streamed to S3 without
+# being decoded, and the fields added to it are only kept in their metadata.
+# Validation decodes every body and saves it with the added fields, as packed
+# mode always does, and so do updates of copies saved without upstream
+# validators.
+EPD_VALIDATE = os.getenv("EPD_VALIDATE", "false").lower() == "true"
+STREAM_CHUNK_SIZE = 1024 * 1024
+# Records still failing after the HTTP retries are written to a retry batch,
+# that the next listing hands to the Map again, up to this many times.
+RETRIES_PREFIX = f"retries/{FOLDER_NAME}/"
+EPD_MAX_RETRY_ATTEMPTS = int(os.getenv("EPD_MAX_RETRY_ATTEMPTS", "5"))
+# Records are no longer started when less than this is left before the Lambda
+# timeout; it must cover the slowest record already in flight.
+EPD_TIME_MARGIN_MS = int(os.getenv("EPD_TIME_MARGIN_SECONDS", "120")) * 1000
+COUNT_KEYS = (
+    "fetchedCount",
+    "skippedCount",
+    "createdCount",
+    "updatedCount",
+    "unchangedCount",
+    "errorsCount",
+)
+
+eco_platform_auth = BearerTokenAuth(API_TOKEN_PARAMETER)
 
-s3 = boto3.client("s3")
-ssm = boto3.client("ssm", region_name="eu-west-3")
+s3 = boto3.client(
+    "s3", config=Config(max_pool_connections=max(10, EPD_FETCH_CONCURRENCY))
+)
+# Records already run in a pool of threads, so uploads do not start their own.
+# Bodies above the multipart threshold are uploaded one 8 MiB part at a time.
+upload_config = TransferConfig(use_threads=False)
 
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 
-def get_epd_data(epd_info: dict) -> dict:
+def get_epd_data(
+    epd_info: dict,
+    costs: dict = None,
+    stored_metadata: dict = None,
+    deadline: float = None,
+) -> Optional[dict]:
+    """Download an EPD, or return None if the server says the stored copy is current."""
     uuid, uri, version = (
         epd_info[UUID_KEY],
         epd_info[URI_KEY],
         epd_info[EPD_VERSION_KEY],
     )
     uri = uri.replace(" ", "")
-    headers = {"Authorization": f"Bearer {get_api_token()}"}
     params = {
         "format": "json",
     }
-    response = requests.get(uri, headers=headers, params=params)
+    headers = get_conditional_headers(stored_metadata or {})
     try:
-        epd_data = response.json()
+        start = time.monotonic()
+        response = http_client.get(
+            uri,
+            params=params,
+            headers=headers,
+            auth=eco_platform_auth,
+            deadline=deadline,
+        )
+        if response.status_code == 304:
+            logger.info(f"EPD with UUID {uuid} not modified upstream")
+            return None
+        response.raise_for_status()
+        if costs is not None:
+            # Body bytes as received, which stream_epd_data_to_s3 records too.
+            costs[uuid] = [
+                response.raw.tell(),
+                round(time.monotonic() - start, 3),
+                http_client.get_host(uri),
+            ]
+        epd_data = codec.response_json(response)
         epd_data[PDF_URL_KEY] = get_pdf_url(uri, uuid, version)
         epd_data[UUID_KEY] = uuid
         epd_data[URI_KEY] = uri
         epd_data[DATASET_VERSION_KEY] = version
         epd_data[ERROR_KEY] = False
+        epd_data[ETAG_KEY] = response.headers.get("ETag")
+        epd_data[LAST_MODIFIED_KEY] = response.headers.get("Last-Modified")
     except Exception as e:
         epd_data = {
             UUID_KEY: uuid,
@@ -55,51 +139,204 @@ def get_epd_data(epd_info: dict) -> dict:
     return epd_data
 
 
-def get_api_token() -> str:
-    parameter_name = "/etl/ECOPLATFORM_TOKEN"
-    try:
-        response = ssm.get_parameter(Name=parameter_name, WithDecryption=False)
-        return response["Parameter"]["Value"]
-    except Exception as e:
-        logger.error(f"Error retrieving API token: {e}")
-        raise e
+def get_conditional_headers(stored_metadata: dict) -> dict:
+    headers = {}
+    if stored_metadata.get(ETAG_KEY):
+        headers["If-None-Match"] = stored_metadata[ETAG_KEY]
+    if stored_metadata.get(LAST_MODIFIED_KEY):
+        headers["If-Modified-Since"] = stored_metadata[LAST_MODIFIED_KEY]
+    return headers
 
 
-def get_pdf_url(uri: str, uuid: str, version: str) -> str:
-    base_url = uri.split("resource/")[0] + "resource/processes"
-    url = f"{base_url}/{uuid}/epd"
-    if version:
-        url += f"?version={version}"
-    return url
+def is_same_content(stored_sha256: Optional[str], content_sha256: str, epd_data: dict) -> bool:
+    """Whether a stored copy hashed as `stored_sha256` holds `epd_data`.
+
+    Copies saved before the codec module were hashed from the default
+    `json.dumps` output, and orjson writes some floats unlike the json
+    fallback, so the hashes of those encodings match too rather than every
+    stored EPD being rewritten once.
+    """
+    if stored_sha256 is None:
+        return False
+    if stored_sha256 == content_sha256:
+        return True
+    other_bodies = (
+        lambda: json.dumps(epd_data).encode("utf-8"),
+        lambda: json.dumps(epd_data, ensure_ascii=False, separators=(",", ":")).encode("utf-8"),
+    )
+    return any(hashlib.sha256(body()).hexdigest() == stored_sha256 for body in other_bodies)
 
 
-def save_epd_data_to_s3(epd_data: dict):
-    errors_count, duplicates_count = 0, 0
+def save_epd_data_to_s3(
+    epd_data: dict,
+    stored_metadata: dict = None,
+    shard_writer: shards.ShardWriter = None,
+) -> str:
+    """Save an EPD unless the stored copy has the same content, and return the outcome."""
     if epd_data.get(ERROR_KEY):
-        errors_count += 1
         logger.warning(f"Error while retrieving data for EPD: {epd_data}")
+        return ERROR_KEY
+
+    uuid = epd_data[UUID_KEY]
+    # The validators change with every response and are kept in the metadata
+    # only, so that the content hash reflects the EPD itself.
+    validators = {
+        key: value
+        for key in (ETAG_KEY, LAST_MODIFIED_KEY)
+        for value in [epd_data.pop(key, None)]
+        if value
+    }
+    body = codec.dumps(epd_data)
+    content_sha256 = hashlib.sha256(body).hexdigest()
+    # Unchanged content is still rewritten when the validators changed, so
+    # that the next revalidation sends the current ones.
+    if (
+        stored_metadata is not None
+        and is_same_content(stored_metadata.get(CONTENT_SHA256_KEY), content_sha256, epd_data)
+        and all(stored_metadata.get(key) == value for key, value in validators.items())
+    ):
+        logger.info(f"EPD with UUID {uuid} unchanged in S3")
+        return UNCHANGED
+
+    metadata = {
+        DATASET_VERSION_KEY: epd_data[DATASET_VERSION_KEY],
+        EPD_VERSION_KEY: epd_data[EPD_VERSION_KEY],
+        URI_KEY: epd_data[URI_KEY],
+        UUID_KEY: epd_data[UUID_KEY],
+        PDF_URL_KEY: epd_data[PDF_URL_KEY],
+        CONTENT_SHA256_KEY: content_sha256,
+        **validators,
+    }
+    if shard_writer is not None:
+        shard_writer.write(uuid, body, metadata)
     else:
-        uuid = epd_data[UUID_KEY]
-        if is_object_in_s3(uuid):
-            logger.info(f"EPD with UUID {uuid} already saved in S3")
-            # TODO: Update instead of ignoring
-            duplicates_count += 1
-        else:
+        s3.put_object(
+            Bucket=BUCKET_NAME,
+            Key=get_epd_json_file_key(uuid),
+            ContentType="application/json",
+            **storage.get_put_object_args(body, metadata),
+        )
+    if stored_metadata is None:
+        return CREATED
+    logger.info(f"EPD with UUID {uuid} updated in S3")
+    return UPDATED
+
+
+def stream_epd_data_to_s3(
+    epd_info: dict,
+    costs: dict = None,
+    stored_metadata: dict = None,
+    deadline: float = None,
+) -> str:
+    """Stream an EPD from upstream to S3 without decoding it, and return the outcome.
+
+    The body is saved as received, or compressed on the fly with the storage
+    codec, and the fields `get_epd_data` adds to it go to the metadata only.
+    """
+    uuid, uri, version = (
+        epd_info[UUID_KEY],
+        epd_info[URI_KEY],
+        epd_info[EPD_VERSION_KEY],
+    )
+    uri = uri.replace(" ", "")
+    params = {
+        "format": "json",
+    }
+    headers = get_conditional_headers(stored_metadata or {})
+    storage_codec = storage.EPD_STORAGE_CODEC
+    try:
+        start = time.monotonic()
+        with http_client.get(
+            uri,
+            params=params,
+            headers=headers,
+            auth=eco_platform_auth,
+            stream=True,
+            deadline=deadline,
+        ) as response:
+            if response.status_code == 304:
+                logger.info(f"EPD with UUID {uuid} not modified upstream")
+                return UNCHANGED
+            response.raise_for_status()
+            if (
+                storage_codec == storage.GZIP
+                and response.headers.get("Content-Encoding") == storage.GZIP
+            ):
+                # Already compressed with the storage codec: saved as sent.
+                chunks = check_json_body(
+                    response,
+                    response.raw.stream(STREAM_CHUNK_SIZE, decode_content=False),
+                    gzipped=True,
+                )
+            else:
+                chunks = storage.encode_chunks(
+                    check_json_body(
+                        response, response.iter_content(chunk_size=STREAM_CHUNK_SIZE)
+                    ),
+                    storage_codec,
+                )
+            validators = {
+                key: value
+                for key, value in (
+                    (ETAG_KEY, response.headers.get("ETag")),
+                    (LAST_MODIFIED_KEY, response.headers.get("Last-Modified")),
+                )
+                if value
+            }
             metadata = {
-                DATASET_VERSION_KEY: epd_data[DATASET_VERSION_KEY],
-                EPD_VERSION_KEY: epd_data[EPD_VERSION_KEY],
-                URI_KEY: epd_data[URI_KEY],
-                UUID_KEY: epd_data[UUID_KEY],
-                PDF_URL_KEY: epd_data[PDF_URL_KEY],
+                DATASET_VERSION_KEY: version,
+                URI_KEY: uri,
+                UUID_KEY: uuid,
+                PDF_URL_KEY: get_pdf_url(uri, uuid, version),
+                storage.CODEC_KEY: storage_codec,
+                **validators,
             }
-            s3.put_object(
-                Body=json.dumps(epd_data),
-                Bucket=BUCKET_NAME,
-                Key=get_epd_json_file_key(uuid),
-                Metadata=metadata,
-                ContentType="application/json",
+            extra_args = {"ContentType": "application/json", "Metadata": metadata}
+            if storage_codec != storage.NO_CODEC:
+                extra_args["ContentEncoding"] = storage_codec
+            body = storage.ChunksReader(chunks)
+            s3.upload_fileobj(
+                body,
+                BUCKET_NAME,
+                get_epd_json_file_key(uuid),
+                ExtraArgs=extra_args,
+                Config=upload_config,
             )
-    return errors_count, duplicates_count
+            # Body bytes as received, whatever the storage codec made of them.
+            received_size = response.raw.tell()
+    except Exception as e:
+        logger.warning(f"Error retrieving data for UUID: {uuid} - {e}")
+        return ERROR_KEY
+
+    if costs is not None:
+        costs[uuid] = [
+            received_size,
+            round(time.monotonic() - start, 3),
+            http_client.get_host(uri),
+        ]
+    if stored_metadata is None:
+        return CREATED
+    logger.info(f"EPD with UUID {uuid} updated in S3")
+    return UPDATED
+
+
+def check_json_body(
+    response: requests.Response, chunks: Iterable[bytes], gzipped: bool = False
+) -> Iterator[bytes]:
+    """Return the chunks of a body once its type and first bytes are those of JSON.
+
+    A login or error page served with a 200 would otherwise be saved as the
+    EPD, and taken as current by every later run.
+    """
+    content_type = response.headers.get("Content-Type", "")
+    if "json" not in content_type:
+        raise ValueError(f"Unexpected content type {content_type!r}")
+    chunks = iter(chunks)
+    first_chunk = next(chunks, b"")
+    head = zlib.decompressobj(wbits=31).decompress(first_chunk, 64) if gzipped else first_chunk
+    if not head.lstrip().startswith(b"{"):
+        raise ValueError(f"Not a JSON object: {head[:32]!r}")
+    return itertools.chain([first_chunk], chunks)
 
 
 def get_epd_json_file_name(id: str) -> str:
@@ -110,43 +347,208 @@ def get_epd_json_file_key(id) -> str:
     return f"{FOLDER_NAME}/{get_epd_json_file_name(id)}"
 
 
-def is_object_in_s3(id: str) -> bool:
+def get_stored_epd_metadata(id: str, stored_ids: set = None) -> Optional[dict]:
+    """Return the metadata of the saved copy of an EPD, or None if there is none."""
+    if stored_ids is not None and id not in stored_ids:
+        return None
     try:
-        s3.head_object(Bucket=BUCKET_NAME, Key=get_epd_json_file_key(id))
-        return True
+        response = s3.head_object(Bucket=BUCKET_NAME, Key=get_epd_json_file_key(id))
     except ClientError as e:
         if e.response["Error"]["Code"] == "404":
-            return False
-        else:
-            raise Exception(f"Error while checking if EPD is already is s3: {e}")
+            return None
+        raise e
+    return response["Metadata"]
+
+
+def list_stored_epd_ids() -> set:
+    """Return the UUIDs of every EPD saved under FOLDER_NAME.
+
+    One paginated listing (1000 keys per call) replaces a HEAD request per
+    record when checking for duplicates.
+    """
+    prefix = f"{FOLDER_NAME}/"
+    stored_ids = set()
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=BUCKET_NAME, Prefix=prefix):
+        for content in page.get("Contents", []):
+            file_name = content["Key"][len(prefix) :]
+            if file_name.endswith(".json") and "/" not in file_name:
+                stored_ids.add(file_name[: -len(".json")])
+    return stored_ids
 
 
-def get_batch_data_from_s3(s3_key: str) -> list:
-    response = s3.get_object(Bucket=BUCKET_NAME, Key=s3_key)
-    batch_data = json.loads(response["Body"].read().decode("utf-8"))
-    return batch_data["batchId"], batch_data["epdInfos"]
+def save_epd_costs_to_s3(costs: dict):
+    # The listing merges these parts and packs the next batches from them.
+    s3_key = f"costs/{FOLDER_NAME}/parts/{uuid4()}.json"
+    s3.put_object(Bucket=BUCKET_NAME, Key=s3_key, Body=codec.dumps(costs))
 
 
-def remove_batch_data_from_s3(s3_key: str):
-    s3.delete_object(Bucket=BUCKET_NAME, Key=s3_key)
+def get_pending_epd_info(
+    epd_info: dict, get_stored_metadata: Callable, refresh: bool = False
+) -> Optional[tuple]:
+    """Pair a record with its stored metadata, or return None if the saved copy is current."""
+    stored_metadata = get_stored_metadata(epd_info[UUID_KEY])
+    if (
+        not refresh
+        and stored_metadata is not None
+        and stored_metadata.get(DATASET_VERSION_KEY) == epd_info[EPD_VERSION_KEY]
+    ):
+        return None
+    return epd_info, stored_metadata
+
+
+def load_packed_epd_index(batch: dict) -> dict:
+    """Load the compacted shard index the listing gave the batch, or merge them all."""
+    if batch.get("shardIndexS3Key"):
+        try:
+            return shards.read_shard_index(s3, BUCKET_NAME, batch["shardIndexS3Key"])
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "NoSuchKey":
+                raise e
+            # A later listing compacted it again in the meantime.
+            logger.warning(f"Shard index {batch['shardIndexS3Key']} no longer exists")
+    return shards.load_shard_index(s3, BUCKET_NAME, SHARDS_PREFIX)
+
+
+def process_epd_info(
+    epd_info: dict,
+    stored_metadata: dict,
+    costs: dict,
+    shard_writer: shards.ShardWriter = None,
+    context=None,
+    validate: bool = EPD_VALIDATE,
+) -> str:
+    # Records not started before the time margin are deferred rather than cut
+    # off by the Lambda timeout.
+    if not batches.has_time_left(context, EPD_TIME_MARGIN_MS):
+        return DEFERRED
+    # The HTTP calls of records give up by then, leaving half the time margin
+    # to save the results of the batch.
+    deadline = batches.get_deadline(context, EPD_TIME_MARGIN_MS / 2)
+    # A stored copy without validators is only found unchanged by hashing the
+    # decoded EPD, which streaming does not do, so it is never streamed over.
+    streamable = stored_metadata is None or bool(get_conditional_headers(stored_metadata))
+    if shard_writer is None and not validate and streamable:
+        outcome = stream_epd_data_to_s3(epd_info, costs, stored_metadata, deadline)
+    else:
+        epd_data = get_epd_data(epd_info, costs, stored_metadata, deadline)
+        if epd_data is None:
+            return UNCHANGED
+        outcome = save_epd_data_to_s3(epd_data, stored_metadata, shard_writer)
+    # A record cut short by the deadline is continued rather than retried later.
+    if outcome == ERROR_KEY and http_client.is_past(deadline):
+        return DEFERRED
+    return outcome
 
 
 def lambda_handler(event: str, context):
-    errors_count, duplicates_count = 0, 0
-    batch_id, epd_infos = get_batch_data_from_s3(event["s3Key"])
-    for epd_info in epd_infos:
-        epd_data = get_epd_data(epd_info)
-        curr_errors, curr_duplicates = save_epd_data_to_s3(epd_data)
-        errors_count += curr_errors
-        duplicates_count += curr_duplicates
+    # Fail before downloading anything if the codec cannot be used.
+    storage.check_codec(storage.EPD_STORAGE_CODEC)
+    http_client.reset_stats()
+    costs = {}
+    # A batch that ran out of time is continued with the previous result as
+    # input, whose counts are carried over.
+    previous = event if event.get("continuation") else None
+    batch = event["continuation"] if previous else event
+    # PDF retry batches only hold EPDs whose PDF failed: their data was saved
+    # with the batch they were first listed in.
+    if batch.get("pdfRetryBatch"):
+        return {
+            "batchId": batch["batchId"],
+            **{key: 0 for key in COUNT_KEYS},
+            "shardKeys": [],
+            "retryKeys": [],
+            "iterations": 1,
+            "continuation": None,
+        }
+    batch_id, epd_infos = batches.get_batch_data_from_s3(s3, BUCKET_NAME, batch)
+    if EPD_OUTPUT_MODE == PACKED_MODE:
+        # Shard indexes already hold the stored metadata, so no HEAD is needed.
+        shard_index = load_packed_epd_index(batch)
+        logger.info(f"Found {len(shard_index)} EPDs already packed in S3")
+        get_stored_metadata = shard_index.get
+        shard_writer = shards.ShardWriter(s3, BUCKET_NAME, SHARDS_PREFIX)
+    else:
+        stored_ids = list_stored_epd_ids()
+        logger.info(f"Found {len(stored_ids)} EPDs already saved in S3")
+        get_stored_metadata = lambda id: get_stored_epd_metadata(id, stored_ids)
+        shard_writer = None
+    concurrency = max(1, batch.get("fetchConcurrency", EPD_FETCH_CONCURRENCY))
+    refresh = batch.get("refresh", EPD_REFRESH)
+    validate = batch.get("validate", EPD_VALIDATE)
+    # Records are independent and almost entirely I/O bound (S3 HEAD, HTTP GET
+    # and S3 PUT), so they are processed by a pool of `concurrency` threads.
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        # Only the records already saved cost a HEAD, to compare their version
+        # with the listed one before anything is downloaded. Downloads of saved
+        # records are conditional, so an unchanged EPD costs an empty 304.
+        pending_infos = [
+            pending_info
+            for pending_info in executor.map(
+                lambda epd_info: get_pending_epd_info(
+                    epd_info, get_stored_metadata, refresh
+                ),
+                epd_infos,
+            )
+            if pending_info is not None
+        ]
+        outcomes = list(
+            executor.map(
+                lambda pending_info: process_epd_info(
+                    *pending_info, costs, shard_writer, context, validate
+                ),
+                pending_infos,
+            )
+        )
+    shard_key = shard_writer.close() if shard_writer is not None else None
 
-    logger.info(
-        f"Processed batch of {len(epd_infos)} records, with {errors_count} errors and {duplicates_count} duplicates."
+    failed_infos, deferred_infos = [], []
+    for (epd_info, _), outcome in zip(pending_infos, outcomes):
+        if outcome == ERROR_KEY:
+            failed_infos.append(epd_info)
+        elif outcome == DEFERRED:
+            deferred_infos.append(epd_info)
+    retry_key = batches.save_retry_batch_to_s3(
+        s3, BUCKET_NAME, RETRIES_PREFIX, failed_infos, EPD_MAX_RETRY_ATTEMPTS
     )
-    remove_batch_data_from_s3(event["s3Key"])
+    if batch.get("retryBatch"):
+        # Its records are saved, or in the new retry or continuation batch by now.
+        s3.delete_object(Bucket=BUCKET_NAME, Key=batch["s3Key"])
+    continuation = None
+    if deferred_infos:
+        # The options of the batch item, like fetchConcurrency, carry over.
+        continuation = dict(
+            batch,
+            retryBatch=False,
+            **batches.save_continuation_batch_to_s3(
+                s3, BUCKET_NAME, BATCHES_PREFIX, batch_id, deferred_infos
+            ),
+        )
+    outcomes = Counter(outcomes)
 
-    return {
+    result = {
         "batchId": batch_id,
-        "errorsCount": errors_count,
-        "duplicatesCount": duplicates_count,
+        "fetchedCount": len(pending_infos) - outcomes[DEFERRED],
+        "skippedCount": len(epd_infos) - len(pending_infos),
+        "createdCount": outcomes[CREATED],
+        "updatedCount": outcomes[UPDATED],
+        "unchangedCount": outcomes[UNCHANGED],
+        "errorsCount": outcomes[ERROR_KEY],
+        "shardKeys": [shard_key] if shard_key else [],
+        "retryKeys": [retry_key] if retry_key else [],
+        "iterations": 1,
+        "continuation": continuation,
     }
+    logger.info(
+        f"Processed batch of {len(epd_infos)} records: {result['skippedCount']} already up to date, "
+        f"{result['fetchedCount']} fetched, {result['createdCount']} created, {result['updatedCount']} updated, "
+        f"{result['unchangedCount']} unchanged, {result['errorsCount']} errors and {len(deferred_infos)} deferred."
+    )
+    if costs:
+        save_epd_costs_to_s3(costs)
+    http_client.log_stats()
+
+    if previous:
+        for key in COUNT_KEYS + ("shardKeys", "retryKeys", "iterations"):
+            result[key] = previous[key] + result[key]
+    return result
@@ -0,0 +1,270 @@
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import os
+from uuid import uuid4
+import boto3
+from botocore.config import Config
+import logging
+
+from common import batches, codec, http_client
+from common.eco_platform import get_pdf_url
+from common.credentials import BearerTokenAuth
+
+
+UUID_KEY = "uuid"
+URI_KEY = "uri"
+EPD_VERSION_KEY = "version"
+API_TOKEN_PARAMETER = "/etl/ECOPLATFORM_TOKEN"
+BUCKET_NAME = os.getenv("BUCKET_NAME")
+FOLDER_NAME = "eco"
+# PDF contents are stored once per sha256 under by-hash/, and each uuid/version
+# gets a small JSON pointer to its content under by-uuid/.
+PDF_PREFIX = f"pdfs/{FOLDER_NAME}/"
+PDF_BY_HASH_PREFIX = f"{PDF_PREFIX}by-hash/"
+PDF_BY_UUID_PREFIX = f"{PDF_PREFIX}by-uuid/"
+PDF_STAGING_PREFIX = f"{PDF_PREFIX}staging/"
+# PDFs still failing after the HTTP retries are written to a retry batch, that
+# the next listing hands to the Map again, up to this many times.
+PDF_RETRIES_PREFIX = f"{PDF_PREFIX}retries/"
+PDF_MAX_RETRY_ATTEMPTS = int(os.getenv("PDF_MAX_RETRY_ATTEMPTS", "5"))
+BATCHES_PREFIX = f"batches/{FOLDER_NAME}/"
+PDF_FETCH_CONCURRENCY = int(os.getenv("PDF_FETCH_CONCURRENCY", "4"))
+PDF_TIME_MARGIN_MS = int(os.getenv("PDF_TIME_MARGIN_SECONDS", "120")) * 1000
+STREAM_CHUNK_SIZE = 1024 * 1024
+# S3 parts must be at least 5 MiB, except the last one, and smaller parts keep
+# less in memory per thread.
+MULTIPART_PART_SIZE = 5 * 1024 * 1024
+SAVED, DUPLICATE, MISSING, ERROR, DEFERRED = (
+    "saved",
+    "duplicate",
+    "missing",
+    "error",
+    "deferred",
+)
+COUNT_KEYS = ("savedCount", "duplicatesCount", "missingCount", "errorsCount")
+
+eco_platform_auth = BearerTokenAuth(API_TOKEN_PARAMETER)
+
+s3 = boto3.client(
+    "s3", config=Config(max_pool_connections=max(10, PDF_FETCH_CONCURRENCY))
+)
+
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+class PdfUpload:
+    """Streams a PDF to a staging object while computing its sha256.
+
+    At most one part is held in memory: parts are uploaded as soon as they
+    reach MULTIPART_PART_SIZE, and PDFs smaller than one part are sent with a
+    single PUT on close.
+    """
+
+    def __init__(self):
+        self.s3_key = f"{PDF_STAGING_PREFIX}{uuid4()}.pdf"
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+        self.upload_id = None
+        self.parts = []
+        self.buffer = bytearray()
+
+    def write(self, chunk: bytes):
+        self.sha256.update(chunk)
+        self.size += len(chunk)
+        self.buffer += chunk
+        if len(self.buffer) >= MULTIPART_PART_SIZE:
+            self.upload_part()
+
+    def upload_part(self):
+        if self.upload_id is None:
+            response = s3.create_multipart_upload(
+                Bucket=BUCKET_NAME, Key=self.s3_key, ContentType="application/pdf"
+            )
+            self.upload_id = response["UploadId"]
+        part_number = len(self.parts) + 1
+        response = s3.upload_part(
+            Bucket=BUCKET_NAME,
+            Key=self.s3_key,
+            UploadId=self.upload_id,
+            PartNumber=part_number,
+            Body=self.buffer,
+        )
+        self.parts.append({"PartNumber": part_number, "ETag": response["ETag"]})
+        self.buffer = bytearray()
+
+    def close(self) -> str:
+        """Complete the upload and return the hex sha256 of the PDF."""
+        if self.upload_id is None:
+            s3.put_object(
+                Bucket=BUCKET_NAME,
+                Key=self.s3_key,
+                Body=self.buffer,
+                ContentType="application/pdf",
+            )
+        else:
+            if self.buffer:
+                self.upload_part()
+            s3.complete_multipart_upload(
+                Bucket=BUCKET_NAME,
+                Key=self.s3_key,
+                UploadId=self.upload_id,
+                MultipartUpload={"Parts": self.parts},
+            )
+        return self.sha256.hexdigest()
+
+    def abort(self):
+        if self.upload_id is not None:
+            s3.abort_multipart_upload(
+                Bucket=BUCKET_NAME, Key=self.s3_key, UploadId=self.upload_id
+            )
+
+
+def get_pdf_pointer_key(uuid: str, version: str) -> str:
+    return f"{PDF_BY_UUID_PREFIX}{uuid}/{version or 'latest'}.json"
+
+
+def get_pdf_content_key(sha256: str) -> str:
+    return f"{PDF_BY_HASH_PREFIX}{sha256}.pdf"
+
+
+def list_keys(prefix: str) -> set:
+    keys = set()
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=BUCKET_NAME, Prefix=prefix):
+        keys.update(content["Key"] for content in page.get("Contents", []))
+    return keys
+
+
+def save_pdf_to_s3(epd_info: dict, stored_keys: set) -> str:
+    uuid, version = epd_info[UUID_KEY], epd_info[EPD_VERSION_KEY]
+    url = get_pdf_url(epd_info[URI_KEY].replace(" ", ""), uuid, version)
+    upload = PdfUpload()
+    try:
+        with http_client.get(url, auth=eco_platform_auth, stream=True) as response:
+            if response.status_code == 404:
+                logger.info(f"No PDF for EPD with UUID {uuid}")
+                return MISSING
+            response.raise_for_status()
+            for chunk in response.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+                if upload.size == 0 and not chunk.startswith(b"%PDF"):
+                    raise ValueError(f"Not a PDF document: {chunk[:32]!r}")
+                upload.write(chunk)
+        # An empty body never reaches the %PDF check above.
+        if upload.size == 0:
+            raise ValueError("Empty PDF document")
+        sha256 = upload.close()
+    except Exception as e:
+        upload.abort()
+        logger.warning(f"Error retrieving PDF for UUID: {uuid} - {e}")
+        return ERROR
+
+    content_key = get_pdf_content_key(sha256)
+    outcome = DUPLICATE if content_key in stored_keys else SAVED
+    if outcome == SAVED:
+        s3.copy_object(
+            Bucket=BUCKET_NAME,
+            Key=content_key,
+            CopySource={"Bucket": BUCKET_NAME, "Key": upload.s3_key},
+            ContentType="application/pdf",
+            MetadataDirective="REPLACE",
+        )
+        stored_keys.add(content_key)
+    s3.delete_object(Bucket=BUCKET_NAME, Key=upload.s3_key)
+
+    pointer = {
+        UUID_KEY: uuid,
+        EPD_VERSION_KEY: version,
+        "url": url,
+        "sha256": sha256,
+        "size": upload.size,
+        "s3Key": content_key,
+    }
+    s3.put_object(
+        Bucket=BUCKET_NAME,
+        Key=get_pdf_pointer_key(uuid, version),
+        Body=codec.dumps(pointer),
+        ContentType="application/json",
+    )
+    return outcome
+
+
+def process_epd_info(epd_info: dict, stored_keys: set, context=None) -> str:
+    if not batches.has_time_left(context, PDF_TIME_MARGIN_MS):
+        return DEFERRED
+    return save_pdf_to_s3(epd_info, stored_keys)
+
+
+def lambda_handler(event: str, context):
+    http_client.reset_stats()
+    previous = event if event.get("continuation") else None
+    batch = event["continuation"] if previous else event
+    result = {key: 0 for key in COUNT_KEYS}
+    result.update(batchId=batch["batchId"], skippedCount=0, retryKeys=[], continuation=None)
+    # Retry batches only hold EPDs whose data failed: their PDFs were handled
+    # with the batch they were first listed in.
+    if batch.get("retryBatch"):
+        return result
+
+    batch_id, epd_infos = batches.get_batch_data_from_s3(s3, BUCKET_NAME, batch)
+    # Two listings answer every "already stored" check of the batch.
+    stored_keys = list_keys(PDF_BY_UUID_PREFIX) | list_keys(PDF_BY_HASH_PREFIX)
+    pending_infos = [
+        epd_info
+        for epd_info in epd_infos
+        if get_pdf_pointer_key(epd_info[UUID_KEY], epd_info[EPD_VERSION_KEY])
+        not in stored_keys
+    ]
+    concurrency = max(1, batch.get("fetchConcurrency", PDF_FETCH_CONCURRENCY))
+    # Memory stays bounded by one part per thread, whatever the PDF sizes.
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        outcomes = list(
+            executor.map(
+                lambda epd_info: process_epd_info(epd_info, stored_keys, context),
+                pending_infos,
+            )
+        )
+
+    failed_infos, deferred_infos = [], []
+    for epd_info, outcome in zip(pending_infos, outcomes):
+        if outcome == ERROR:
+            failed_infos.append(epd_info)
+        elif outcome == DEFERRED:
+            deferred_infos.append(epd_info)
+    retry_key = batches.save_retry_batch_to_s3(
+        s3, BUCKET_NAME, PDF_RETRIES_PREFIX, failed_infos, PDF_MAX_RETRY_ATTEMPTS
+    )
+    if retry_key:
+        result["retryKeys"] = [retry_key]
+    if batch.get("pdfRetryBatch"):
+        # Its PDFs are saved, or in the new retry or continuation batch by now.
+        s3.delete_object(Bucket=BUCKET_NAME, Key=batch["s3Key"])
+    if deferred_infos:
+        result["continuation"] = dict(
+            batch,
+            pdfRetryBatch=False,
+            **batches.save_continuation_batch_to_s3(
+                s3, BUCKET_NAME, BATCHES_PREFIX, batch_id, deferred_infos
+            ),
+        )
+    outcomes = Counter(outcomes)
+    result.update(
+        skippedCount=len(epd_infos) - len(pending_infos),
+        savedCount=outcomes[SAVED],
+        duplicatesCount=outcomes[DUPLICATE],
+        missingCount=outcomes[MISSING],
+        errorsCount=outcomes[ERROR],
+    )
+    logger.info(
+        f"Processed PDFs of {len(epd_infos)} EPDs: {result['skippedCount']} already stored, "
+        f"{result['savedCount']} saved, {result['duplicatesCount']} duplicates, "
+        f"{result['missingCount']} missing, {result['errorsCount']} errors and {len(deferred_infos)} deferred."
+    )
+    http_client.log_stats()
+
+    if previous:
+        for key in COUNT_KEYS + ("skippedCount", "retryKeys"):
+            result[key] = previous[key] + result[key]
+    return result
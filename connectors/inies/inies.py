@@ -1,15 +1,31 @@
-import json
 import random
 
 import pymongo
 import requests
 from tqdm import tqdm
 
+from common import codec, http_client
+
 URL_BASE_INIES = "https://www.base-inies.fr"
 URL_BASE_INIES_API = f"{URL_BASE_INIES}/iniesV4/dist"
 LOCAL_MONGO_URL = "mongodb://localhost:27017/"
 MONGO_DB_NAME = "epd_data"
 MONGO_COLLECTION_NAME = "epd_inies"
+INIES_HEADERS = {
+    "accept": "application/json, text/plain, */*",
+    "accept-language": "en-US,en;q=0.9",
+    "content-type": "application/json",
+    "priority": "u=1, i",
+    "sec-ch-ua": '"Not;A=Brand";v="24", "Chromium";v="128"',
+    "sec-ch-ua-mobile": "?0",
+    "sec-ch-ua-platform": '"macOS"',
+    "sec-fetch-dest": "empty",
+    "sec-fetch-mode": "cors",
+    "sec-fetch-site": "same-origin",
+    "user-agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/128.0.0.0 Safari/537.36",
+}
+
+http_client.set_default_headers(http_client.get_host(URL_BASE_INIES), INIES_HEADERS)
 
 
 class Inies:
@@ -22,23 +38,10 @@ class Inies:
     def get_all_product_ids() -> list:
         url = f"{URL_BASE_INIES_API}/api/SearchProduits"
         headers = {
-            "accept": "application/json, text/plain, */*",
-            "accept-language": "en-US,en;q=0.6",
-            "content-type": "application/json",
-            "dnt": "1",
             "origin": URL_BASE_INIES,
-            "priority": "u=1, i",
             "referer": f"{URL_BASE_INIES_API}/recherche-fdes",
-            "sec-ch-ua": '"Chromium";v="128", "Not;A=Brand";v="24", "Brave";v="128"',
-            "sec-ch-ua-mobile": "?0",
-            "sec-ch-ua-platform": '"macOS"',
-            "sec-fetch-dest": "empty",
-            "sec-fetch-mode": "cors",
-            "sec-fetch-site": "same-origin",
-            "sec-gpc": "1",
-            "user-agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/128.0.0.0 Safari/537.36",
         }
-        data = json.dumps(
+        data = codec.dumps(
             {
                 "typeDeclaration": 0,
                 "cov": 0,
@@ -49,26 +52,13 @@ class Inies:
                 "onlyArchive": False,
             }
         )
-        return requests.post(url, headers=headers, data=data).json()
+        return codec.response_json(http_client.post(url, headers=headers, data=data))
 
     @staticmethod
     def get_product_response(id: int) -> requests.Response:
         product_url = f"{URL_BASE_INIES_API}/api/Produit/{id}"
-        headers = {
-            "accept": "application/json, text/plain, */*",
-            "accept-language": "en-US,en;q=0.9",
-            "content-type": "application/json",
-            "priority": "u=1, i",
-            "referer": f"{URL_BASE_INIES_API}/infos-produit",
-            "sec-ch-ua": '"Not;A=Brand";v="24", "Chromium";v="128"',
-            "sec-ch-ua-mobile": "?0",
-            "sec-ch-ua-platform": '"macOS"',
-            "sec-fetch-dest": "empty",
-            "sec-fetch-mode": "cors",
-            "sec-fetch-site": "same-origin",
-            "user-agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/128.0.0.0 Safari/537.36",
-        }
-        return requests.get(product_url, headers=headers)
+        headers = {"referer": f"{URL_BASE_INIES_API}/infos-produit"}
+        return http_client.get(product_url, headers=headers)
 
     def save_all_products_data(self):
         ids = self.get_all_product_ids()
@@ -77,7 +67,7 @@ class Inies:
         for id in tqdm(ids):
             response = self.get_product_response(id)
             if response.status_code == 200:
-                json_data = response.json()
+                json_data = codec.response_json(response)
                 if self.collection.find_one({"_id": id}):
                     print(f"Product {id} already exists in the collection")
                     self.collection.update_one({"_id": id}, {"$set": json_data})
@@ -87,6 +77,8 @@ class Inies:
             else:
                 print(f"Failed to retrieve product {id}: {response.status_code}")
 
+        http_client.log_stats()
+
 
 if __name__ == "__main__":
     inies = Inies(LOCAL_MONGO_URL, MONGO_DB_NAME, MONGO_COLLECTION_NAME)
@@ -11,6 +11,7 @@ setup(
     description="Python-based tool to retrieve EPDs from different websites.",
     packages=find_packages(),
     install_requires=requirements,
+    extras_require={"zstd": ["zstandard"], "pdf": ["pypdf"], "orjson": ["orjson"]},
     test_suite="tests",
     # include_package_data: to install data from MANIFEST.in
     include_package_data=True,
@@ -0,0 +1,59 @@
+import io
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+
+
+def make_response(url: str, status: int = 200, body: bytes = b"", headers: dict = None):
+    """A response read from `body` the way the HTTP adapter reads a socket."""
+    raw = urllib3.HTTPResponse(
+        body=io.BytesIO(body),
+        headers=headers or {},
+        status=status,
+        preload_content=False,
+        decode_content=False,
+    )
+    request = requests.Request("GET", url).prepare()
+    return HTTPAdapter().build_response(request, raw)
+
+
+class FakeServer:
+    """Local keep-alive HTTP server, answering each GET or POST with `respond(path,
+    headers)`, a (status, body, headers) tuple."""
+
+    def __init__(self, respond):
+        self.respond = respond
+        self.paths = []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                server.paths.append(self.path)
+                status, body, headers = server.respond(self.path, self.headers)
+                self.send_response(status)
+                for name, value in {"Content-Length": str(len(body)), **headers}.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            do_POST = do_GET
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.httpd.server_port}"
+
+    def __enter__(self) -> "FakeServer":
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.httpd.shutdown()
+        self.httpd.server_close()
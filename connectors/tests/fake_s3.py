@@ -0,0 +1,121 @@
+import io
+import itertools
+import threading
+
+from botocore.exceptions import ClientError
+
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+
+def not_found(operation: str, code: str = "NoSuchKey") -> ClientError:
+    return ClientError({"Error": {"Code": code, "Message": "Not Found"}}, operation)
+
+
+class FakeS3:
+    """The S3 calls the connectors make, on an in-memory bucket."""
+
+    def __init__(self):
+        self.objects = {}
+        self.uploads = {}
+        self.clock = itertools.count()
+        self.lock = threading.Lock()
+
+    def store(self, key: str, body: bytes, metadata: dict = None, **kwargs):
+        with self.lock:
+            self.objects[key] = {
+                "Body": bytes(body),
+                "Metadata": dict(metadata or {}),
+                "LastModified": next(self.clock),
+                **kwargs,
+            }
+
+    def read(self, key: str) -> bytes:
+        return self.objects[key]["Body"]
+
+    def keys(self, prefix: str = "") -> list:
+        return sorted(key for key in self.objects if key.startswith(prefix))
+
+    def put_object(self, Bucket, Key, Body, Metadata=None, **kwargs):
+        if hasattr(Body, "read"):
+            Body = Body.read()
+        if isinstance(Body, str):
+            Body = Body.encode("utf-8")
+        self.store(Key, Body, Metadata, **kwargs)
+        return {"ETag": f'"{Key}"'}
+
+    def get_object(self, Bucket, Key, Range=None):
+        if Key not in self.objects:
+            raise not_found("GetObject")
+        stored = self.objects[Key]
+        body = stored["Body"]
+        if Range is not None:
+            start, end = map(int, Range[len("bytes=") :].split("-"))
+            body = body[start : end + 1]
+        response = {key: value for key, value in stored.items() if key != "Body"}
+        return dict(response, Body=io.BytesIO(body), ContentLength=len(body))
+
+    def head_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise not_found("HeadObject", "404")
+        stored = self.objects[Key]
+        response = {key: value for key, value in stored.items() if key != "Body"}
+        return dict(response, ContentLength=len(stored["Body"]))
+
+    def delete_object(self, Bucket, Key):
+        with self.lock:
+            self.objects.pop(Key, None)
+
+    def delete_objects(self, Bucket, Delete):
+        for deleted in Delete["Objects"]:
+            self.delete_object(Bucket, deleted["Key"])
+        return {"Deleted": Delete["Objects"]}
+
+    def copy_object(self, Bucket, Key, CopySource, MetadataDirective="COPY", **kwargs):
+        if CopySource["Key"] not in self.objects:
+            raise not_found("CopyObject")
+        source = self.objects[CopySource["Key"]]
+        if MetadataDirective == "REPLACE":
+            self.store(Key, source["Body"], kwargs.pop("Metadata", None), **kwargs)
+        else:
+            self.store(Key, source["Body"], source["Metadata"])
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        with self.lock:
+            upload_id = f"upload-{len(self.uploads)}"
+            self.uploads[upload_id] = (Key, {}, kwargs)
+        return {"UploadId": upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self.uploads[UploadId][1][PartNumber] = bytes(Body)
+        return {"ETag": f'"{UploadId}-{PartNumber}"'}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        key, parts, kwargs = self.uploads.pop(UploadId)
+        numbers = [part["PartNumber"] for part in MultipartUpload["Parts"]]
+        for number in numbers[:-1]:
+            assert len(parts[number]) >= MIN_PART_SIZE, f"Part {number} is too small"
+        body = b"".join(parts[number] for number in numbers)
+        self.store(key, body, kwargs.pop("Metadata", None), **kwargs)
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.uploads.pop(UploadId, None)
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, ExtraArgs=None, Config=None):
+        chunks = iter(lambda: Fileobj.read(MIN_PART_SIZE), b"")
+        extra_args = dict(ExtraArgs or {})
+        self.store(Key, b"".join(chunks), extra_args.pop("Metadata", None), **extra_args)
+
+    def get_paginator(self, name):
+        return self
+
+    def paginate(self, Bucket, Prefix=""):
+        yield {
+            "Contents": [
+                {
+                    "Key": key,
+                    "Size": len(self.objects[key]["Body"]),
+                    "LastModified": self.objects[key]["LastModified"],
+                }
+                for key in self.keys(Prefix)
+            ]
+        }
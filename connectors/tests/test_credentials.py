@@ -0,0 +1,74 @@
+import pytest
+
+from common import credentials, http_client
+from tests.fake_http import FakeServer
+
+PARAMETER = "/etl/TOKEN"
+
+
+class FakeSSM:
+    def __init__(self, *tokens: str):
+        self.tokens = list(tokens)
+        self.calls = 0
+
+    def get_parameter(self, Name, WithDecryption):
+        self.calls += 1
+        return {"Parameter": {"Name": Name, "Value": self.tokens.pop(0)}}
+
+
+@pytest.fixture
+def ssm(monkeypatch) -> FakeSSM:
+    ssm = FakeSSM("old", "new", "newer")
+    monkeypatch.setattr(credentials, "ssm", ssm)
+    monkeypatch.setattr(credentials, "_tokens", {})
+    return ssm
+
+
+def serve_token(token: str) -> FakeServer:
+    """Serve 200 to requests bearing `token`, and 401 to any other."""
+
+    def respond(path, headers):
+        if headers.get("Authorization") == f"Bearer {token}":
+            return 200, b"{}", {}
+        return 401, b"Unauthorized", {}
+
+    return FakeServer(respond)
+
+
+def test_token_is_read_once_per_ttl(ssm):
+    assert credentials.get_parameter_token(PARAMETER) == "old"
+    assert credentials.get_parameter_token(PARAMETER) == "old"
+    assert ssm.calls == 1
+
+    # Refreshed a margin before it expires.
+    token, expires = credentials._tokens[PARAMETER]
+    credentials._tokens[PARAMETER] = (token, expires - credentials.TOKEN_TTL)
+    assert credentials.get_parameter_token(PARAMETER) == "new"
+    assert ssm.calls == 2
+
+
+def test_rejected_token_is_read_again_once(ssm):
+    assert credentials.get_parameter_token(PARAMETER) == "old"
+    assert credentials.refresh_parameter_token(PARAMETER, "old") == "new"
+    # Another thread that got "old" rejected too reuses the new token.
+    assert credentials.refresh_parameter_token(PARAMETER, "old") == "new"
+    assert ssm.calls == 2
+
+
+def test_request_is_sent_again_with_a_refreshed_token_on_401(ssm):
+    with serve_token("new") as server:
+        response = http_client.get(f"{server.url}/data", auth=credentials.BearerTokenAuth(PARAMETER))
+
+    assert response.status_code == 200
+    assert [previous.status_code for previous in response.history] == [401]
+    assert response.request.headers["Authorization"] == "Bearer new"
+    assert server.paths == ["/data", "/data"]
+
+
+def test_refreshed_token_is_only_tried_once(ssm):
+    with serve_token("newer") as server:
+        response = http_client.get(f"{server.url}/data", auth=credentials.BearerTokenAuth(PARAMETER))
+
+    assert response.status_code == 401
+    assert server.paths == ["/data", "/data"]
+    assert ssm.calls == 2
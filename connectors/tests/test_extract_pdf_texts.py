@@ -0,0 +1,61 @@
+import gzip
+import importlib
+import json
+import multiprocessing
+import os
+import time
+
+import pytest
+
+extract_pdf_texts = importlib.import_module("ecoplatform.extract_pdf_texts")
+
+POINTER_PREFIX = extract_pdf_texts.PDF_BY_UUID_PREFIX
+
+
+@pytest.mark.parametrize(
+    "text, values",
+    [
+        ("1.2E+02 -3,4 0.5", [120.0, -3.4, 0.5]),
+        ("1.234,5 1,234.56", [1234.5, 1234.56]),
+        ("1.234.567 1,234,567.8", [1234567.0, 1234567.8]),
+        # A single separator is the decimal mark.
+        ("1,234 1.234", [1.234, 1.234]),
+    ],
+)
+def test_indicator_values_are_read_with_their_separators(text, values):
+    (row,) = extract_pdf_texts.extract_indicators(3, f"GWP-total kg CO2 eq. {text}")
+
+    assert row == {"indicator": "GWP-total", "unit": "kg CO2 eq.", "values": values, "page": 3}
+
+
+def extract_pdf(pointer_key: str) -> dict:
+    uuid = pointer_key[len(POINTER_PREFIX) :].split("/")[0]
+    if uuid == "crash":
+        os._exit(1)
+    if uuid == "stuck":
+        time.sleep(60)
+    return dict(extract_pdf_texts.new_document(pointer_key), pages=[uuid])
+
+
+@pytest.mark.skipif(
+    multiprocessing.get_start_method() != "fork",
+    reason="The patched extraction only reaches forked processes",
+)
+def test_crashed_and_stuck_documents_do_not_end_the_run(monkeypatch, tmp_path):
+    uuids = ["a", "crash", "b", "stuck", "c"]
+    pointers = [f"{POINTER_PREFIX}{uuid}/1.json" for uuid in uuids]
+    monkeypatch.setattr(extract_pdf_texts, "list_pdf_pointers", lambda: pointers)
+    monkeypatch.setattr(extract_pdf_texts, "init_worker", lambda: None)
+    monkeypatch.setattr(extract_pdf_texts, "extract_pdf", extract_pdf)
+    monkeypatch.setattr(extract_pdf_texts, "PDF_EXTRACTION_TIMEOUT", 1)
+    output_path = tmp_path / "pdf_texts.jsonl.gz"
+
+    counts = extract_pdf_texts.extract_pdf_texts(str(output_path), workers=2)
+
+    assert counts == {"documents": 5, "pages": 3, "indicators": 0, "errors": 2}
+    with gzip.open(output_path, "rt") as output:
+        documents = {document["uuid"]: document for document in map(json.loads, output)}
+    assert sorted(documents) == sorted(uuids)
+    assert documents["crash"]["error"] == "Extraction process died with exit code 1"
+    assert documents["stuck"]["error"].startswith("TimeoutError")
+    assert documents["c"]["pages"] == ["c"] and documents["c"]["error"] is None
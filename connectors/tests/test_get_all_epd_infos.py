@@ -0,0 +1,309 @@
+import importlib
+import threading
+import time
+
+import pytest
+import requests
+
+from common import batches, codec, http_client
+from tests.fake_http import make_response
+from tests.fake_s3 import FakeS3
+
+get_all_epd_infos = importlib.import_module("ecoplatform.lambda.get_all_epd_infos")
+commit_listing_manifest = importlib.import_module("ecoplatform.lambda.commit_listing_manifest")
+
+BUCKET = "bucket"
+URL = get_all_epd_infos.URL_EPD_INFOS
+
+
+@pytest.fixture
+def s3(monkeypatch) -> FakeS3:
+    s3 = FakeS3()
+    for module in (get_all_epd_infos, commit_listing_manifest):
+        monkeypatch.setattr(module, "s3", s3)
+        monkeypatch.setattr(module, "BUCKET_NAME", BUCKET)
+    return s3
+
+
+class FakeContext:
+    """Lambda context whose remaining time runs down with the clock."""
+
+    def __init__(self, remaining_ms: int):
+        self.end = time.monotonic() + remaining_ms / 1000
+
+    def get_remaining_time_in_millis(self) -> int:
+        return int((self.end - time.monotonic()) * 1000)
+
+
+def epd_info(id: str, version: str) -> dict:
+    return {"uuid": id, "uri": f"https://node.test/resource/processes/{id}", "version": version}
+
+
+def list_pages(monkeypatch, pages: list, error: Exception = None):
+    """Have the listing yield the (url, next startIndex, EPD infos) `pages` after
+    the checkpointed cursors, then raise `error` if there is one."""
+
+    def iter_listing_pages(checkpoint, *args):
+        for url, next_start_index, epd_infos in pages:
+            if next_start_index > checkpoint["cursors"].get(url, 0):
+                yield url, next_start_index, epd_infos
+        if error is not None:
+            raise error
+
+    monkeypatch.setattr(get_all_epd_infos, "iter_listing_pages", iter_listing_pages)
+
+
+def read_batches(s3: FakeS3, result: dict) -> list:
+    return [
+        [epd_info["uuid"] for epd_info in batches.get_batch_data_from_s3(s3, BUCKET, batch)[1]]
+        for batch in result["inputBatchesS3Keys"]
+    ]
+
+
+def read_json(s3: FakeS3, key: str):
+    return codec.loads(s3.read(key))
+
+
+def commit(result: dict):
+    return commit_listing_manifest.lambda_handler(
+        {"pendingManifestS3Key": result["pendingManifestS3Key"]}, None
+    )
+
+
+def test_only_new_or_updated_epds_are_batched(s3, monkeypatch):
+    s3.put_object(
+        Bucket=BUCKET,
+        Key=get_all_epd_infos.MANIFEST_KEY,
+        Body=codec.dumps({"fingerprint": None, "versions": {"a": "1", "b": "1"}}),
+    )
+    list_pages(
+        monkeypatch,
+        [(URL, 2, [epd_info("a", "1"), epd_info("b", "2")]), (URL, 4, [epd_info("c", "1"), epd_info("a", "1")])],
+    )
+
+    result = get_all_epd_infos.lambda_handler({}, None)
+
+    assert result["listingComplete"] and not result["resumeListing"]
+    assert read_batches(s3, result) == [["b", "c"]]
+    manifest = read_json(s3, result["pendingManifestS3Key"])
+    assert manifest["versions"] == {"a": "1", "b": "2", "c": "1"}
+    assert manifest["fingerprint"] == result["listingFingerprint"]
+    # Not current before its batches are processed.
+    assert read_json(s3, get_all_epd_infos.MANIFEST_KEY)["versions"] == {"a": "1", "b": "1"}
+
+
+def test_committed_manifest_is_the_next_baseline(s3, monkeypatch):
+    list_pages(monkeypatch, [(URL, 2, [epd_info("a", "1"), epd_info("b", "1")])])
+    result = get_all_epd_infos.lambda_handler({}, None)
+    assert read_batches(s3, result) == [["a", "b"]]
+
+    assert commit(result) == {"manifestCommitted": True}
+    assert s3.keys(get_all_epd_infos.PENDING_MANIFESTS_PREFIX) == []
+    assert read_json(s3, get_all_epd_infos.MANIFEST_KEY)["versions"] == {"a": "1", "b": "1"}
+    assert get_all_epd_infos.lambda_handler({}, None)["inputBatchesS3Keys"] == []
+    assert read_batches(s3, get_all_epd_infos.lambda_handler({"fullListing": True}, None)) == [["a", "b"]]
+
+
+def test_uncommitted_manifest_is_listed_again(s3, monkeypatch):
+    list_pages(monkeypatch, [(URL, 2, [epd_info("a", "1")])])
+    get_all_epd_infos.lambda_handler({}, None)
+
+    assert read_batches(s3, get_all_epd_infos.lambda_handler({}, None)) == [["a"]]
+    assert commit({"pendingManifestS3Key": None}) == {"manifestCommitted": False}
+
+
+def test_handed_over_batches_are_not_taken_as_processed(s3, monkeypatch):
+    pages = [(URL, 2, [epd_info("a", "1"), epd_info("b", "1")]), (URL, 3, [epd_info("c", "1")])]
+    list_pages(monkeypatch, pages[:1], requests.exceptions.ConnectionError("502"))
+    last_attempt = get_all_epd_infos.LISTING_MAX_ATTEMPTS - 1
+
+    result = get_all_epd_infos.lambda_handler({"listingAttempt": last_attempt}, None)
+
+    assert not result["listingComplete"] and not result["resumeListing"]
+    assert result["pendingManifestS3Key"] is None
+    assert read_batches(s3, result) == [["a", "b"]]
+    checkpoint = read_json(s3, get_all_epd_infos.CHECKPOINT_KEY)
+    assert checkpoint["cursors"] == {URL: 2}
+    assert checkpoint["batchKeys"] == [] and checkpoint["versions"] == {}
+
+    # The next execution lists from the cursor on, and its manifest only
+    # covers what it batched itself.
+    list_pages(monkeypatch, pages)
+    result = get_all_epd_infos.lambda_handler({}, None)
+    assert result["listingComplete"]
+    assert read_batches(s3, result) == [["c"]]
+    commit(result)
+    assert read_json(s3, get_all_epd_infos.MANIFEST_KEY)["versions"] == {"c": "1"}
+    assert read_batches(s3, get_all_epd_infos.lambda_handler({}, None)) == [["a", "b"]]
+
+
+def serve_pages(
+    monkeypatch, records: list, stuck: threading.Event, stuck_url: str, stuck_index: int
+):
+    """Serve `records` two by two, except that the pages of `stuck_url` from
+    `stuck_index` on hang until `stuck` is set, like a read trickling past
+    every timeout."""
+
+    def get_epd_infos_page(url, params, start_index, page_size, tuner, deadline=None):
+        if url == stuck_url and start_index >= stuck_index:
+            stuck.wait(10)
+        data = records[start_index : start_index + 2]
+        return {"totalCount": len(records), "pageSize": 2, "data": data}
+
+    monkeypatch.setattr(get_all_epd_infos, "get_epd_infos_page", get_epd_infos_page)
+
+
+def test_interrupted_listing_resumes_at_its_cursor(s3, monkeypatch):
+    pages = [(URL, 2, [epd_info("a", "1"), epd_info("b", "1")]), (URL, 4, [epd_info("c", "1"), epd_info("d", "1")])]
+    list_pages(monkeypatch, pages[:1], requests.exceptions.ConnectionError("502"))
+
+    result = get_all_epd_infos.lambda_handler({}, None)
+
+    assert result["resumeListing"] and not result["listingComplete"]
+    assert result["inputBatchesS3Keys"] == [] and result["listingAttempt"] == 1
+    checkpoint = read_json(s3, get_all_epd_infos.CHECKPOINT_KEY)
+    assert checkpoint["cursors"] == {URL: 2} and checkpoint["pagesDone"] == 1
+    assert len(checkpoint["batchKeys"]) == 1
+
+    list_pages(monkeypatch, pages)
+    result = get_all_epd_infos.lambda_handler({"listingAttempt": result["listingAttempt"]}, None)
+
+    assert result["listingComplete"] and result["listingAttempt"] == 1
+    assert read_batches(s3, result) == [["a", "b"], ["c", "d"]]
+    assert get_all_epd_infos.CHECKPOINT_KEY not in s3.objects
+    assert read_json(s3, result["pendingManifestS3Key"])["versions"] == {
+        "a": "1",
+        "b": "1",
+        "c": "1",
+        "d": "1",
+    }
+
+
+def test_listing_pauses_before_the_lambda_timeout(s3, monkeypatch):
+    pages = [(URL, 1, [epd_info("a", "1")]), (URL, 2, [epd_info("b", "1")])]
+    list_pages(monkeypatch, pages)
+    context = FakeContext(get_all_epd_infos.LISTING_TIME_MARGIN_MS - 1000)
+
+    result = get_all_epd_infos.lambda_handler({}, context)
+
+    # Pausing is not a failure, so it never runs out of attempts.
+    assert result["resumeListing"] and result["listingAttempt"] == 0
+    assert read_json(s3, get_all_epd_infos.CHECKPOINT_KEY)["cursors"] == {URL: 1}
+
+
+def test_page_overrunning_the_deadline_pauses_the_listing(s3, monkeypatch):
+    monkeypatch.setattr(get_all_epd_infos, "LISTING_TIME_MARGIN_MS", 400)
+    stuck = threading.Event()
+    serve_pages(monkeypatch, [epd_info(id, "1") for id in "abcd"], stuck, URL, 2)
+    start = time.monotonic()
+    try:
+        result = get_all_epd_infos.lambda_handler({}, FakeContext(1000))
+    finally:
+        stuck.set()
+
+    assert time.monotonic() - start < 2
+    assert result["resumeListing"] and result["listingAttempt"] == 0
+    checkpoint = read_json(s3, get_all_epd_infos.CHECKPOINT_KEY)
+    assert checkpoint["cursors"] == {URL: 2}
+    assert read_batches(s3, {"inputBatchesS3Keys": checkpoint["batchKeys"]}) == [["a", "b"]]
+
+
+def test_stuck_node_does_not_hold_up_the_checkpoint(s3, monkeypatch):
+    monkeypatch.setattr(get_all_epd_infos, "LISTING_TIME_MARGIN_MS", 400)
+    monkeypatch.setattr(get_all_epd_infos, "ECO_PLATFORM_NODES", "https://a.test,https://b.test")
+    stuck = threading.Event()
+    serve_pages(monkeypatch, [epd_info("a", "1")], stuck, "https://b.test/resource/processes", 0)
+    start = time.monotonic()
+    try:
+        result = get_all_epd_infos.lambda_handler({"listingMode": "nodes"}, FakeContext(1000))
+    finally:
+        stuck.set()
+
+    assert time.monotonic() - start < 2
+    assert result["resumeListing"] and result["listingAttempt"] == 0
+    checkpoint = read_json(s3, get_all_epd_infos.CHECKPOINT_KEY)
+    assert checkpoint["cursors"] == {"https://a.test/resource/processes": 1}
+
+
+def test_batches_are_packed_to_the_duration_of_a_worker(s3, monkeypatch):
+    monkeypatch.setattr(get_all_epd_infos, "BATCH_TARGET_SECONDS", 3)
+    list_pages(monkeypatch, [(URL, 40, [epd_info(f"{i:02d}", "1") for i in range(40)])])
+
+    result = get_all_epd_infos.lambda_handler({}, None)
+
+    # Workers process 8 EPDs of DEFAULT_EPD_SECONDS at once.
+    assert [len(ids) for ids in read_batches(s3, result)] == [16, 16, 8]
+    assert [batch["estimatedSeconds"] for batch in result["inputBatchesS3Keys"]] == [3.0, 3.0, 1.5]
+
+
+def test_recorded_costs_are_shared_by_the_epds_processed_at_once():
+    costs = {"a": [5 * 1024 * 1024, 1.0, "node.test"]}
+    estimator = get_all_epd_infos.EpdCostEstimator(costs, concurrency=4)
+
+    assert estimator.estimate(epd_info("a", "1")) == 0.5
+    # Unknown EPDs cost the average of their host, or the default.
+    assert estimator.estimate(epd_info("b", "1")) == 0.5
+    other_host = {"uuid": "c", "uri": "https://other.test/c", "version": "1"}
+    assert estimator.estimate(other_host) == get_all_epd_infos.DEFAULT_EPD_SECONDS / 4
+
+
+def serve_page(monkeypatch, status: int, body: bytes) -> list:
+    """Answer every page request with `body`, and return the responses."""
+    responses = []
+
+    def get(url, **kwargs):
+        responses.append(make_response(url, status, body))
+        return responses[-1]
+
+    monkeypatch.setattr(http_client, "get", get)
+    return responses
+
+
+def test_pages_are_reduced_to_the_listed_fields(monkeypatch):
+    records = [dict(epd_info("a", "1"), name="Concrete", geo="DE"), epd_info("b", "2")]
+    body = codec.dumps({"totalCount": 5, "startIndex": 0, "pageSize": 2, "data": records})
+    serve_page(monkeypatch, 200, body)
+
+    page = get_all_epd_infos.get_epd_infos_page(URL, {}, 0, 2, get_all_epd_infos.PageSizeTuner())
+
+    assert page["totalCount"] == 5
+    assert page["data"] == [epd_info("a", "1"), epd_info("b", "2")]
+
+
+@pytest.mark.parametrize(
+    "body",
+    [
+        b'{"totalCount": 3, "pageSize": 2, "data": [{"uuid": "a", "uri": "u", "version": "1"}, {',
+        b'{"totalCount": 3, "pageSize": 2, "data": [{"uuid": "a", "uri": "u"}]}',
+        b'{"totalCount": 3, "pageSize": 2, "data": "none"}',
+        b'{"totalCount": 3, "pageSize": 2}',
+        b'{"totalCount": 3, "data": []}',
+        b"[]",
+        b"<html>Maintenance</html>",
+    ],
+)
+def test_malformed_pages_are_invalid(monkeypatch, body):
+    serve_page(monkeypatch, 200, body)
+
+    with pytest.raises(requests.exceptions.InvalidJSONError):
+        get_all_epd_infos.get_epd_infos_page(URL, {}, 0, 2, get_all_epd_infos.PageSizeTuner())
+
+
+@pytest.mark.parametrize(
+    "status, body, error",
+    [
+        (502, b"Bad Gateway", requests.exceptions.HTTPError),
+        (200, b'{"totalCount": 3, "data": [{', requests.exceptions.InvalidJSONError),
+        (200, b'{"totalCount": 1, "pageSize": 1, "data": []}', None),
+    ],
+)
+def test_page_responses_are_always_closed(monkeypatch, status, body, error):
+    responses = serve_page(monkeypatch, status, body)
+    tuner = get_all_epd_infos.PageSizeTuner()
+    if error is None:
+        get_all_epd_infos.get_epd_infos_page(URL, {}, 0, 2, tuner)
+    else:
+        with pytest.raises(error):
+            get_all_epd_infos.get_epd_infos_page(URL, {}, 0, 2, tuner)
+
+    assert responses[0].raw.closed
@@ -0,0 +1,204 @@
+import gzip
+import hashlib
+import importlib
+import json
+import time
+
+import pytest
+import requests
+
+from common import batches, codec, http_client, storage
+from tests.fake_http import make_response
+from tests.fake_s3 import FakeS3
+
+get_epd_data = importlib.import_module("ecoplatform.lambda.get_epd_data")
+
+BUCKET = "bucket"
+EPD_BODY = b'{"processInformation": {"dataSetInformation": {"name": "Concrete"}}, "version": "1"}'
+
+
+@pytest.fixture
+def s3(monkeypatch) -> FakeS3:
+    s3 = FakeS3()
+    monkeypatch.setattr(get_epd_data, "s3", s3)
+    monkeypatch.setattr(get_epd_data, "BUCKET_NAME", BUCKET)
+    return s3
+
+
+def epd_info(id: str, version: str = "1") -> dict:
+    return {"uuid": id, "uri": f"https://node.test/resource/processes/{id}", "version": version}
+
+
+def serve(monkeypatch, responses: dict) -> list:
+    """Answer the EPD GETs with `responses`, keyed by uuid, and return the
+    headers each request was sent with."""
+    calls = []
+
+    def get(url, headers=None, stream=False, **kwargs):
+        id = url.rsplit("/", 1)[-1]
+        calls.append((id, dict(headers or {})))
+        response = responses[id]
+        if isinstance(response, Exception):
+            raise response
+        status, body, response_headers = response
+        response_headers = {"Content-Type": "application/json", **response_headers}
+        response = make_response(url, status, body, response_headers)
+        if not stream:
+            response.content
+        return response
+
+    monkeypatch.setattr(http_client, "get", get)
+    return calls
+
+
+@pytest.mark.parametrize(
+    "validate, storage_codec", [(True, "none"), (False, "none"), (False, "gzip")]
+)
+def test_costs_record_the_bytes_received(s3, monkeypatch, validate, storage_codec):
+    monkeypatch.setattr(storage, "EPD_STORAGE_CODEC", storage_codec)
+    compressed = gzip.compress(EPD_BODY)
+    serve(monkeypatch, {"a": (200, compressed, {"Content-Encoding": "gzip"})})
+    costs = {}
+
+    outcome = get_epd_data.process_epd_info(epd_info("a"), None, costs, validate=validate)
+
+    assert outcome == get_epd_data.CREATED
+    assert costs["a"][0] == len(compressed)
+    assert costs["a"][2] == "node.test"
+    assert codec.loads(storage.read_object(s3, BUCKET, "eco/a.json"))["processInformation"]
+
+
+class FakeContext:
+    """Lambda context whose remaining time is set by the test."""
+
+    def __init__(self, remaining_ms: int):
+        self.remaining_ms = remaining_ms
+
+    def get_remaining_time_in_millis(self) -> int:
+        return self.remaining_ms
+
+
+def save_batch(s3: FakeS3, epd_infos: list) -> dict:
+    body = b"".join(codec.dumps(epd_info) + b"\n" for epd_info in epd_infos)
+    s3.store("batches/eco/0.jsonl", body)
+    return {"s3Key": "batches/eco/0.jsonl", "batchId": 0, "byteRange": [0, len(body) - 1]}
+
+
+def test_batches_out_of_time_are_continued_with_their_counts(s3, monkeypatch):
+    monkeypatch.setattr(storage, "EPD_STORAGE_CODEC", "none")
+    s3.store("eco/d.json", EPD_BODY, {"dataset_version": "1"})
+    batch = dict(save_batch(s3, [epd_info(id) for id in "abcd"]), fetchConcurrency=1)
+    context = FakeContext(10 * get_epd_data.EPD_TIME_MARGIN_MS)
+    calls = serve(monkeypatch, {id: (200, EPD_BODY, {}) for id in "abc"})
+    get = http_client.get
+
+    def get_then_run_out_of_time(url, **kwargs):
+        context.remaining_ms = get_epd_data.EPD_TIME_MARGIN_MS
+        return get(url, **kwargs)
+
+    monkeypatch.setattr(http_client, "get", get_then_run_out_of_time)
+    result = get_epd_data.lambda_handler(batch, context)
+
+    assert [id for id, _ in calls] == ["a"]
+    assert (result["fetchedCount"], result["createdCount"], result["skippedCount"]) == (1, 1, 1)
+    continuation = result["continuation"]
+    assert continuation["batchId"] == 0 and continuation["fetchConcurrency"] == 1
+    _, deferred_infos = batches.get_batch_data_from_s3(s3, BUCKET, continuation)
+    assert [deferred_info["uuid"] for deferred_info in deferred_infos] == ["b", "c"]
+
+    context.remaining_ms = 10 * get_epd_data.EPD_TIME_MARGIN_MS
+    monkeypatch.setattr(http_client, "get", get)
+    result = get_epd_data.lambda_handler(result, context)
+
+    assert [id for id, _ in calls] == ["a", "b", "c"]
+    assert result["continuation"] is None
+    assert (result["fetchedCount"], result["createdCount"], result["skippedCount"]) == (3, 3, 1)
+    assert result["iterations"] == 2
+    assert s3.keys("eco/") == ["eco/a.json", "eco/b.json", "eco/c.json", "eco/d.json"]
+
+
+def test_records_cut_short_by_the_deadline_are_deferred(s3, monkeypatch):
+    now = time.monotonic()
+    monkeypatch.setattr(time, "monotonic", lambda: now)
+    context = FakeContext(get_epd_data.EPD_TIME_MARGIN_MS + 1000)
+
+    def get(url, deadline=None, **kwargs):
+        nonlocal now
+        now = deadline
+        raise requests.exceptions.Timeout("Deadline passed")
+
+    monkeypatch.setattr(http_client, "get", get)
+    outcome = get_epd_data.process_epd_info(epd_info("a"), None, {}, context=context)
+
+    assert outcome == get_epd_data.DEFERRED
+    assert s3.keys() == []
+
+
+@pytest.mark.parametrize(
+    "encode",
+    [
+        # Before the codec module.
+        lambda data: json.dumps(data).encode("utf-8"),
+        # The json fallback of the codec, where orjson is missing.
+        lambda data: json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8"),
+        codec.dumps,
+    ],
+)
+def test_copies_hashed_from_other_encodings_are_unchanged(s3, encode):
+    epd_data = {
+        **codec.loads(EPD_BODY),
+        "meanAmount": 1e-05,
+        "name": "Béton",
+        get_epd_data.UUID_KEY: "a",
+        get_epd_data.ERROR_KEY: False,
+    }
+    stored_metadata = {
+        get_epd_data.CONTENT_SHA256_KEY: hashlib.sha256(encode(epd_data)).hexdigest()
+    }
+
+    outcome = get_epd_data.save_epd_data_to_s3(dict(epd_data), stored_metadata)
+
+    assert outcome == get_epd_data.UNCHANGED
+    assert s3.keys() == []
+
+
+def test_copies_with_other_content_are_updated(s3):
+    epd_data = {**codec.loads(EPD_BODY), get_epd_data.ERROR_KEY: False}
+    epd_data.update(uuid="a", uri="https://node.test/a", dataset_version="2", pdf_url=None)
+    stored_metadata = {get_epd_data.CONTENT_SHA256_KEY: hashlib.sha256(b"{}").hexdigest()}
+
+    outcome = get_epd_data.save_epd_data_to_s3(epd_data, stored_metadata)
+
+    assert outcome == get_epd_data.UPDATED
+    assert s3.keys() == ["eco/a.json"]
+
+
+@pytest.mark.parametrize("storage_codec", ["none", "gzip"])
+def test_copies_without_validators_are_compared_by_hash(s3, monkeypatch, storage_codec):
+    monkeypatch.setattr(storage, "EPD_STORAGE_CODEC", storage_codec)
+    serve(monkeypatch, {"a": (200, EPD_BODY, {})})
+    outcomes, epds = [], []
+    for _ in range(3):
+        stored_metadata = get_epd_data.get_stored_epd_metadata("a")
+        outcomes.append(get_epd_data.process_epd_info(epd_info("a"), stored_metadata, {}))
+        epds.append(storage.read_epd(s3, BUCKET, "eco/a.json"))
+
+    # Streamed first, then saved once with its hash, then found unchanged.
+    assert outcomes == [get_epd_data.CREATED, get_epd_data.UPDATED, get_epd_data.UNCHANGED]
+    assert get_epd_data.CONTENT_SHA256_KEY in s3.objects["eco/a.json"]["Metadata"]
+    assert epds[0] == {key: value for key, value in epds[2].items() if key in epds[0]}
+    assert epds[0]["uuid"] == "a" and epds[0]["dataset_version"] == "1"
+
+
+def test_copies_with_validators_are_revalidated(s3, monkeypatch):
+    serve(monkeypatch, {"a": (200, EPD_BODY, {"ETag": '"v1"'})})
+    get_epd_data.process_epd_info(epd_info("a"), None, {})
+    calls = serve(monkeypatch, {"a": (304, b"", {})})
+
+    stored_metadata = get_epd_data.get_stored_epd_metadata("a")
+    outcome = get_epd_data.process_epd_info(epd_info("a"), stored_metadata, {})
+
+    assert outcome == get_epd_data.UNCHANGED
+    assert calls == [("a", {"If-None-Match": '"v1"'})]
+    # Streamed, so with no hash to compare.
+    assert get_epd_data.CONTENT_SHA256_KEY not in stored_metadata
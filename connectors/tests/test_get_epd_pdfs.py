@@ -0,0 +1,124 @@
+import hashlib
+import importlib
+
+import pytest
+
+from common import batches, codec, http_client
+from tests.fake_http import make_response
+from tests.fake_s3 import FakeS3
+
+get_epd_pdfs = importlib.import_module("ecoplatform.lambda.get_epd_pdfs")
+get_epd_data = importlib.import_module("ecoplatform.lambda.get_epd_data")
+get_all_epd_infos = importlib.import_module("ecoplatform.lambda.get_all_epd_infos")
+
+BUCKET = "bucket"
+PDF_BODY = b"%PDF-1.7\n" + b"x" * 1024
+
+
+@pytest.fixture
+def s3(monkeypatch) -> FakeS3:
+    s3 = FakeS3()
+    for module in (get_epd_pdfs, get_epd_data, get_all_epd_infos):
+        monkeypatch.setattr(module, "s3", s3)
+        monkeypatch.setattr(module, "BUCKET_NAME", BUCKET)
+    return s3
+
+
+def epd_info(id: str, version: str = "1") -> dict:
+    return {"uuid": id, "uri": f"https://node.test/resource/processes/{id}", "version": version}
+
+
+def serve(monkeypatch, responses: dict):
+    """Answer the PDF GETs with the (status, body) `responses`, keyed by uuid."""
+
+    def get(url, **kwargs):
+        status, body = responses[url.split("/")[-2]]
+        return make_response(url, status, body, {"Content-Type": "application/pdf"})
+
+    monkeypatch.setattr(http_client, "get", get)
+
+
+def save_batch(s3: FakeS3, key: str, epd_infos: list) -> dict:
+    body = b"".join(codec.dumps(epd_info) + b"\n" for epd_info in epd_infos)
+    s3.store(key, body)
+    return {"s3Key": key, "batchId": 0, "byteRange": [0, len(body) - 1]}
+
+
+def upload_pdf(chunks: list) -> tuple:
+    upload = get_epd_pdfs.PdfUpload()
+    for chunk in chunks:
+        upload.write(chunk)
+    return upload, upload.close()
+
+
+def test_small_pdfs_are_uploaded_with_one_put(s3):
+    upload, sha256 = upload_pdf([PDF_BODY[:10], PDF_BODY[10:]])
+
+    assert upload.upload_id is None
+    assert s3.read(upload.s3_key) == PDF_BODY
+    assert sha256 == hashlib.sha256(PDF_BODY).hexdigest()
+
+
+def test_large_pdfs_are_uploaded_in_parts(s3):
+    chunk = b"%PDF" + b"x" * (1024 * 1024 - 4)
+    body = chunk * 12
+
+    upload, sha256 = upload_pdf([chunk] * 12)
+
+    # 5 MiB parts, then what is left.
+    assert len(upload.parts) == 3
+    assert s3.uploads == {}
+    assert s3.read(upload.s3_key) == body
+    assert sha256 == hashlib.sha256(body).hexdigest()
+    assert upload.size == len(body)
+
+
+def test_aborted_uploads_leave_nothing_behind(s3):
+    upload = get_epd_pdfs.PdfUpload()
+    upload.write(b"%PDF" + b"x" * get_epd_pdfs.MULTIPART_PART_SIZE)
+
+    upload.abort()
+
+    assert s3.uploads == {}
+    assert s3.keys() == []
+
+
+def test_failed_pdfs_are_retried_by_a_later_run(s3, monkeypatch):
+    serve(monkeypatch, {"a": (200, PDF_BODY), "b": (500, b""), "c": (200, b"<html>")})
+    batch = save_batch(s3, "batches/eco/0.jsonl", [epd_info(id) for id in "abc"])
+
+    result = get_epd_pdfs.lambda_handler(batch, None)
+
+    assert (result["savedCount"], result["errorsCount"]) == (1, 2)
+    (retry_key,) = result["retryKeys"]
+    assert retry_key.startswith(get_epd_pdfs.PDF_RETRIES_PREFIX)
+
+    # The next listing hands the retry batch to the PDF worker only.
+    (retry_batch,) = get_all_epd_infos.list_retry_batches(0)
+    assert retry_batch["s3Key"] == retry_key and retry_batch["pdfRetryBatch"]
+    data_result = get_epd_data.lambda_handler(retry_batch, None)
+    assert data_result["fetchedCount"] == 0 and data_result["retryKeys"] == []
+
+    serve(monkeypatch, {"b": (200, PDF_BODY + b"b"), "c": (500, b"")})
+    result = get_epd_pdfs.lambda_handler(retry_batch, None)
+
+    assert (result["savedCount"], result["errorsCount"]) == (1, 1)
+    assert retry_key not in s3.objects
+    (retry_key,) = result["retryKeys"]
+    byte_range = [0, len(s3.read(retry_key)) - 1]
+    _, retry_infos = batches.get_batch_data_from_s3(
+        s3, BUCKET, {"s3Key": retry_key, "batchId": 0, "byteRange": byte_range}
+    )
+    assert [(info["uuid"], info[batches.RETRY_ATTEMPTS_KEY]) for info in retry_infos] == [("c", 2)]
+
+
+def test_pdfs_are_given_up_on_after_the_last_attempt(s3, monkeypatch):
+    serve(monkeypatch, {"a": (500, b"")})
+    attempts = {batches.RETRY_ATTEMPTS_KEY: get_epd_pdfs.PDF_MAX_RETRY_ATTEMPTS}
+    failed_info = dict(epd_info("a"), **attempts)
+    batch = dict(save_batch(s3, "pdfs/eco/retries/0.jsonl", [failed_info]), pdfRetryBatch=True)
+
+    result = get_epd_pdfs.lambda_handler(batch, None)
+
+    assert result["errorsCount"] == 1 and result["retryKeys"] == []
+    assert s3.keys(get_epd_pdfs.PDF_RETRIES_PREFIX) == []
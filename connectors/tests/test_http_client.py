@@ -0,0 +1,169 @@
+import threading
+import time
+
+import pytest
+import requests
+
+from common import http_client, rate_limiter
+from tests.fake_http import FakeServer
+
+
+def test_responses_left_open_do_not_hang_the_host(monkeypatch):
+    monkeypatch.setattr(http_client, "POOL_MAXSIZE", 1)
+    monkeypatch.setattr(http_client, "_sessions", {})
+    statuses, leaked = [], []
+
+    def fetch(url: str):
+        for _ in range(2):
+            leaked.append(http_client.get(url, stream=True, retries=0))
+        statuses.append(http_client.get(url, retries=0).status_code)
+
+    with FakeServer(lambda path, headers: (502, b"x" * 1024 * 1024, {})) as server:
+        thread = threading.Thread(target=fetch, args=(f"{server.url}/page",), daemon=True)
+        thread.start()
+        thread.join(5)
+        for response in leaked:
+            response.close()
+
+    assert statuses == [502]
+
+
+@pytest.fixture
+def sleeps(monkeypatch) -> list:
+    """Delays slept between retries, which return at once."""
+    sleeps = []
+    monkeypatch.setattr(http_client.time, "sleep", sleeps.append)
+    monkeypatch.setattr(rate_limiter, "RATE_LIMIT_ENABLED", False)
+    monkeypatch.setattr(http_client, "_sessions", {})
+    return sleeps
+
+
+def answer(*statuses):
+    """Answer requests with `statuses` in turn, then with 200."""
+    statuses = iter(statuses)
+
+    def respond(path, headers):
+        status = next(statuses, 200)
+        if isinstance(status, tuple):
+            return status[0], b"", status[1]
+        return status, b"", {}
+
+    return respond
+
+
+def test_transient_statuses_are_retried_with_backoff(sleeps):
+    with FakeServer(answer(502, 503, 429)) as server:
+        response = http_client.get(f"{server.url}/page")
+
+    assert response.status_code == 200
+    assert len(server.paths) == 4
+    assert len(sleeps) == 3
+    for attempt, delay in enumerate(sleeps):
+        assert 0 <= delay <= http_client.BACKOFF_BASE * 2**attempt
+
+
+def test_last_response_is_returned_once_retries_run_out(sleeps):
+    with FakeServer(answer(500, 500, 500)) as server:
+        response = http_client.get(f"{server.url}/page", retries=2)
+
+    assert response.status_code == 500
+    assert len(server.paths) == 3
+
+
+def test_other_statuses_are_not_retried(sleeps):
+    with FakeServer(answer(404)) as server:
+        response = http_client.get(f"{server.url}/page")
+
+    assert response.status_code == 404
+    assert server.paths == ["/page"]
+    assert sleeps == []
+
+
+def test_retry_after_is_honoured(sleeps):
+    with FakeServer(answer((429, {"Retry-After": "7"}))) as server:
+        response = http_client.get(f"{server.url}/page")
+
+    assert response.status_code == 200
+    assert sleeps == [7.0]
+
+
+def test_retry_after_beyond_backoff_max_is_not_waited_for(sleeps):
+    retry_after = str(int(http_client.BACKOFF_MAX) + 1)
+    with FakeServer(answer((503, {"Retry-After": retry_after}))) as server:
+        response = http_client.get(f"{server.url}/page")
+
+    assert response.status_code == 503
+    assert len(server.paths) == 1
+    assert sleeps == []
+
+
+def test_post_is_not_retried_by_default(sleeps):
+    with FakeServer(answer(503)) as server:
+        response = http_client.post(f"{server.url}/token")
+        assert response.status_code == 503
+        assert len(server.paths) == 1
+
+        response = http_client.post(f"{server.url}/token", retries=1)
+
+    assert response.status_code == 200
+
+
+def test_connection_errors_are_retried(sleeps):
+    with FakeServer(answer()) as server:
+        url = f"{server.url}/page"
+    # The server is gone, so every attempt is refused.
+    with pytest.raises(requests.exceptions.ConnectionError):
+        http_client.get(url, retries=2)
+
+    assert len(sleeps) == 2
+
+
+def test_timeouts_are_cut_to_the_time_left():
+    deadline = time.monotonic() + 2
+
+    connect_timeout, read_timeout = http_client.get_timeout((5, 60), deadline)
+
+    assert 0 < connect_timeout <= 2 and 0 < read_timeout <= 2
+    assert http_client.get_timeout((5, 60)) == (5, 60)
+
+
+def test_no_request_is_sent_past_the_deadline(sleeps):
+    with FakeServer(answer()) as server:
+        with pytest.raises(requests.exceptions.Timeout):
+            http_client.get(f"{server.url}/page", deadline=time.monotonic() - 1)
+
+    assert server.paths == []
+
+
+def test_no_retry_waits_past_the_deadline(sleeps, monkeypatch):
+    monkeypatch.setattr(http_client, "get_backoff", lambda attempt: 10.0)
+    deadline = time.monotonic() + 5
+    with FakeServer(answer(503)) as server:
+        response = http_client.get(f"{server.url}/page", deadline=deadline)
+        assert response.status_code == 503
+
+        with FakeServer(answer()) as gone:
+            url = f"{gone.url}/page"
+        with pytest.raises(requests.exceptions.ConnectionError):
+            http_client.get(url, deadline=deadline)
+
+    assert len(server.paths) == 1
+    assert sleeps == []
+
+
+def test_slow_responses_give_up_at_the_deadline(monkeypatch):
+    monkeypatch.setattr(rate_limiter, "RATE_LIMIT_ENABLED", False)
+    released = threading.Event()
+
+    def respond(path, headers):
+        released.wait(5)
+        return 200, b"{}", {}
+
+    with FakeServer(respond) as server:
+        start = time.monotonic()
+        with pytest.raises(requests.exceptions.Timeout):
+            http_client.get(f"{server.url}/page", retries=0, deadline=start + 0.3)
+        elapsed = time.monotonic() - start
+        released.set()
+
+    assert elapsed < 2
@@ -0,0 +1,97 @@
+import time
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+
+import pytest
+
+from common import rate_limiter
+
+
+class FakeClock:
+    """Stands in for the time module, so that waits take no real time."""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def time(self) -> float:
+        return time.time()
+
+    def sleep(self, seconds: float):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch) -> FakeClock:
+    clock = FakeClock()
+    monkeypatch.setattr(rate_limiter, "time", clock)
+    return clock
+
+
+def test_parse_retry_after():
+    assert rate_limiter.parse_retry_after(None) is None
+    assert rate_limiter.parse_retry_after("") is None
+    assert rate_limiter.parse_retry_after("12") == 12.0
+    assert rate_limiter.parse_retry_after("-3") == 0.0
+    assert rate_limiter.parse_retry_after("soon") is None
+    in_a_minute = format_datetime(datetime.now(timezone.utc) + timedelta(minutes=1), usegmt=True)
+    assert 55 < rate_limiter.parse_retry_after(in_a_minute) <= 60
+
+
+def test_burst_then_rate(clock):
+    limiter = rate_limiter.HostRateLimiter("host", rate=10)
+    for _ in range(int(rate_limiter.RATE_LIMIT_BURST)):
+        limiter.acquire()
+    assert clock.sleeps == []
+    limiter.acquire()
+    assert clock.sleeps and sum(clock.sleeps) == pytest.approx(0.1)
+
+
+def test_throttling_halves_the_rate_once_per_cooldown(clock):
+    limiter = rate_limiter.HostRateLimiter("host", rate=10)
+    limiter.record(429, 0.1)
+    assert limiter.rate == 5
+    # Responses already in flight when the rate was cut do not cut it again.
+    limiter.record(503, 0.1)
+    assert limiter.rate == 5
+    clock.now += rate_limiter.DECREASE_COOLDOWN
+    limiter.record(None, 0.1)
+    assert limiter.rate == 2.5
+
+
+def test_rate_never_drops_below_the_minimum(clock):
+    limiter = rate_limiter.HostRateLimiter("host", rate=rate_limiter.RATE_LIMIT_MIN)
+    limiter.record(429, 0.1)
+    assert limiter.rate == rate_limiter.RATE_LIMIT_MIN
+
+
+def test_retry_after_blocks_the_host_up_to_the_cap(clock):
+    limiter = rate_limiter.HostRateLimiter("host", rate=10)
+    limiter.record(429, 0.1, "3600")
+    assert limiter.blocked_until == clock.now + rate_limiter.MAX_BLOCK
+    limiter.acquire()
+    assert sum(clock.sleeps) == pytest.approx(rate_limiter.MAX_BLOCK)
+
+
+def test_healthy_responses_raise_the_rate_up_to_the_maximum(clock):
+    limiter = rate_limiter.HostRateLimiter("host", rate=10)
+    limiter.record(200, 0.1)
+    assert limiter.rate > 10
+    limiter.rate = rate_limiter.RATE_LIMIT_MAX
+    limiter.record(200, 0.1)
+    assert limiter.rate == rate_limiter.RATE_LIMIT_MAX
+
+
+def test_slow_responses_lower_the_rate(clock):
+    limiter = rate_limiter.HostRateLimiter("host", rate=10)
+    for _ in range(20):
+        limiter.record(200, 0.1)
+    rate = limiter.rate
+    for _ in range(5):
+        limiter.record(200, 5.0)
+        clock.now += rate_limiter.DECREASE_COOLDOWN
+    assert limiter.rate < rate
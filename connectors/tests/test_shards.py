@@ -0,0 +1,105 @@
+import io
+import itertools
+
+from common import shards
+
+BUCKET = "bucket"
+PREFIX = "shards/eco/"
+
+
+class FakeS3:
+    """The few S3 calls shards makes, on an in-memory bucket."""
+
+    def __init__(self):
+        self.objects = {}
+        self.clock = itertools.count()
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.objects[Key] = (bytes(Body), next(self.clock))
+
+    def get_object(self, Bucket, Key, Range=None):
+        body = self.objects[Key][0]
+        if Range is not None:
+            start, end = map(int, Range[len("bytes=") :].split("-"))
+            body = body[start : end + 1]
+        return {"Body": io.BytesIO(body), "Metadata": {}}
+
+    def delete_objects(self, Bucket, Delete):
+        for deleted in Delete["Objects"]:
+            del self.objects[deleted["Key"]]
+
+    def get_paginator(self, name):
+        return self
+
+    def paginate(self, Bucket, Prefix):
+        yield {
+            "Contents": [
+                {"Key": key, "LastModified": modified}
+                for key, (_, modified) in sorted(self.objects.items())
+                if key.startswith(Prefix)
+            ]
+        }
+
+
+def write_shard(s3: FakeS3, records: dict) -> str:
+    writer = shards.ShardWriter(s3, BUCKET, PREFIX)
+    for id, version in records.items():
+        body = f'{{"uuid": "{id}", "version": "{version}"}}'.encode()
+        writer.write(id, body, {"dataset_version": version})
+    return writer.close()
+
+
+def test_empty_shard_is_not_written():
+    s3 = FakeS3()
+    assert shards.ShardWriter(s3, BUCKET, PREFIX).close() is None
+    assert s3.objects == {}
+
+
+def test_records_are_read_by_range_and_sequentially():
+    s3 = FakeS3()
+    shard_key = write_shard(s3, {"a": "1", "b": "2", "c": "3"})
+    index = shards.load_shard_index(s3, BUCKET, PREFIX)
+    assert set(index) == {"a", "b", "c"}
+    assert index["b"]["shard"] == shard_key
+    assert index["b"]["dataset_version"] == "2"
+    assert shards.read_shard_record(s3, BUCKET, index["b"]) == {"uuid": "b", "version": "2"}
+    records = list(shards.iter_shard_records(s3, BUCKET, shard_key))
+    assert [record["uuid"] for record in records] == ["a", "b", "c"]
+
+
+def test_newest_shard_wins():
+    s3 = FakeS3()
+    write_shard(s3, {"a": "1", "b": "1"})
+    newer_key = write_shard(s3, {"b": "2"})
+    index = shards.load_shard_index(s3, BUCKET, PREFIX)
+    assert index["a"]["dataset_version"] == "1"
+    assert index["b"]["dataset_version"] == "2"
+    assert index["b"]["shard"] == newer_key
+
+
+def test_compaction_keeps_every_record_in_one_index():
+    s3 = FakeS3()
+    write_shard(s3, {"a": "1", "b": "1"})
+    write_shard(s3, {"b": "2", "c": "2"})
+    index = shards.load_shard_index(s3, BUCKET, PREFIX)
+
+    compacted_key = shards.compact_shard_indexes(s3, BUCKET, PREFIX)
+    assert shards.list_index_keys(s3, BUCKET, PREFIX) == [compacted_key]
+    assert shards.read_shard_index(s3, BUCKET, compacted_key) == index
+    assert shards.load_shard_index(s3, BUCKET, PREFIX) == index
+    assert shards.read_shard_record(s3, BUCKET, index["a"]) == {"uuid": "a", "version": "1"}
+
+    # A later compaction merges the compacted index with the new shards only.
+    write_shard(s3, {"c": "3"})
+    compacted_key = shards.compact_shard_indexes(s3, BUCKET, PREFIX)
+    compacted = shards.read_shard_index(s3, BUCKET, compacted_key)
+    assert {id: entry["dataset_version"] for id, entry in compacted.items()} == {
+        "a": "1",
+        "b": "2",
+        "c": "3",
+    }
+    assert shards.compact_shard_indexes(s3, BUCKET, PREFIX) == compacted_key
+
+
+def test_nothing_to_compact():
+    assert shards.compact_shard_indexes(FakeS3(), BUCKET, PREFIX) is None
@@ -0,0 +1,115 @@
+import gzip
+
+import pytest
+
+from common import codec, storage
+from tests.fake_s3 import FakeS3
+
+BUCKET = "bucket"
+BODY = codec.dumps({"uuid": "a", "name": "Béton C30/37", "values": list(range(200))})
+CODECS = [
+    storage.NO_CODEC,
+    storage.GZIP,
+    pytest.param(
+        storage.ZSTD,
+        marks=pytest.mark.skipif(storage.zstandard is None, reason="zstandard is not installed"),
+    ),
+]
+
+
+@pytest.mark.parametrize("storage_codec", CODECS)
+def test_bodies_round_trip(storage_codec):
+    encoded = storage.encode(BODY, storage_codec)
+
+    assert storage.decode(encoded, storage_codec) == BODY
+    if storage_codec != storage.NO_CODEC:
+        assert len(encoded) < len(BODY)
+
+
+@pytest.mark.parametrize("storage_codec", CODECS)
+def test_streamed_chunks_decode_like_whole_bodies(storage_codec):
+    chunks = [BODY[i : i + 100] for i in range(0, len(BODY), 100)]
+
+    encoded = b"".join(storage.encode_chunks(iter(chunks), storage_codec))
+
+    assert storage.decode(encoded, storage_codec) == BODY
+
+
+def test_gzip_output_is_stable():
+    # mtime=0 keeps the stored bytes, and so their ETag, the same across runs.
+    assert storage.encode(BODY, storage.GZIP) == storage.encode(BODY, storage.GZIP)
+    streamed = b"".join(storage.encode_chunks([BODY], storage.GZIP))
+    assert gzip.decompress(streamed) == BODY
+    assert streamed[4:8] == b"\x00\x00\x00\x00"
+
+
+def test_unknown_codec_is_rejected():
+    with pytest.raises(ValueError):
+        storage.check_codec("brotli")
+    with pytest.raises(ValueError):
+        storage.encode(BODY, "brotli")
+
+
+@pytest.mark.skipif(storage.zstandard is not None, reason="zstandard is installed")
+def test_zstd_requires_zstandard():
+    with pytest.raises(ImportError):
+        storage.check_codec(storage.ZSTD)
+
+
+@pytest.mark.parametrize("storage_codec", CODECS)
+def test_stored_objects_are_read_whatever_their_codec(storage_codec):
+    s3 = FakeS3()
+    args = storage.get_put_object_args(BODY, {"uuid": "a"}, storage_codec)
+    s3.put_object(Bucket=BUCKET, Key="eco/a.json", **args)
+
+    assert args["Metadata"] == {"uuid": "a", storage.CODEC_KEY: storage_codec}
+    assert args.get("ContentEncoding") == (
+        None if storage_codec == storage.NO_CODEC else storage_codec
+    )
+    assert storage.read_object(s3, BUCKET, "eco/a.json") == BODY
+
+
+def test_objects_written_before_codecs_are_read():
+    s3 = FakeS3()
+    s3.put_object(Bucket=BUCKET, Key="plain.json", Body=BODY)
+    s3.put_object(
+        Bucket=BUCKET, Key="encoded.json", Body=gzip.compress(BODY), ContentEncoding="gzip"
+    )
+
+    assert storage.read_object(s3, BUCKET, "plain.json") == BODY
+    assert storage.read_object(s3, BUCKET, "encoded.json") == BODY
+
+
+@pytest.mark.parametrize("size", [-1, 1, 7, 64, 10_000])
+def test_chunks_reader_reads_across_chunks(size):
+    chunks = [b"", BODY[:5], b"", BODY[5:100], BODY[100:]]
+    reader = storage.ChunksReader(iter(chunks))
+
+    parts = list(iter(lambda: reader.read(size), b""))
+
+    assert b"".join(parts) == BODY
+    if size > 0:
+        assert all(len(part) == size for part in parts[:-1])
+    assert reader.read() == b""
+
+
+def test_streamed_epds_get_their_metadata_fields_back():
+    s3 = FakeS3()
+    metadata = {"uuid": "a", "uri": "https://node.test/a", "dataset_version": "2", "pdf_url": "p"}
+    s3.put_object(
+        Bucket=BUCKET,
+        Key="eco/a.json",
+        **storage.get_put_object_args(b'{"version": "2", "uuid": "kept"}', metadata, storage.GZIP),
+    )
+
+    epd = storage.read_epd(s3, BUCKET, "eco/a.json")
+
+    # Fields of the body win over those of the metadata.
+    assert epd == {
+        "version": "2",
+        "uuid": "kept",
+        "uri": "https://node.test/a",
+        "dataset_version": "2",
+        "pdf_url": "p",
+        "error": False,
+    }